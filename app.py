@@ -1,14 +1,27 @@
-from flask import Flask, render_template, request, jsonify, send_file, url_for, redirect
+from flask import Flask, render_template, request, jsonify, url_for, redirect, Response
 from dotenv import load_dotenv
 import os
 import re
 import logging
 import json
 import uuid
+import csv
+import tempfile
+from io import StringIO
+import time
+import threading
 import requests
+import cliente_frete
+import despacho
+import tokens_frete
+import compressao
+import json_rapido
+import perfil
+from tabela_rotas import TabelaRotas, chave_rota, formatar_cotado_em
+from collections import Counter
 from datetime import datetime
 import xml.etree.ElementTree as ET
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
 # ---------------------------------------------------------------------
 # Logging (logo após imports, para capturar tudo)
@@ -23,7 +36,7 @@ load_dotenv()
 # Tentativa de importar o blueprint externo (opcional)
 # ---------------------------------------------------------------------
 try:
-    from massa_blueprint import massa_bp  # precisa definir 'massa_bp' lá
+    from massa_blueprint import massa_bp, precarregar_dependencias  # precisa definir 'massa_bp' lá
     logger.info("Blueprint 'massa_bp' importado com sucesso")
 except Exception as e:
     import traceback
@@ -31,17 +44,59 @@ except Exception as e:
     traceback.print_exc()
     massa_bp = None
 
+# pandas/openpyxl só são importados no primeiro uso da massa. Com MASSA_PRECARREGAR=1 o
+# gunicorn.conf.py liga o preload (com o monkey patch do gevent antes do import do app):
+# o master importa uma vez e os workers herdam (copy-on-write). Não use `--preload` na
+# linha de comando com o worker gevent: o app seria importado sem o patch.
+if massa_bp is not None and os.environ.get('MASSA_PRECARREGAR') == '1':
+    try:
+        precarregar_dependencias()
+        logger.info("pandas/openpyxl pré-carregados")
+    except ImportError:
+        logger.exception("Falha ao pré-carregar pandas/openpyxl")
+
 # ---------------------------------------------------------------------
 # Configuração do app
 # ---------------------------------------------------------------------
 app = Flask(__name__, static_folder='static', template_folder='templates')
+app.json = json_rapido.ProvedorJSON(app)  # orjson quando instalado; senão, json da stdlib
 app.secret_key = os.environ.get('SECRET_KEY', 'chave-secreta-padrao-mude-isso-em-producao')
 app.config['UPLOAD_FOLDER'] = 'Uploads'            # Corresponde ao esperado pelo blueprint
-app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 10 MB
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 10)) * 1024 * 1024  # upload XLSX (buffer)
+app.config['MASSA_STREAM_MAX_MB'] = int(os.environ.get('MASSA_STREAM_MAX_MB', 500))  # upload CSV/NDJSON em streaming
+app.config['MASSA_STREAM_BUFFER_LINHAS'] = int(os.environ.get('MASSA_STREAM_BUFFER_LINHAS', 200))
+app.config['MASSA_PARCIAL_ESPERA'] = float(os.environ.get('MASSA_PARCIAL_ESPERA', 20))      # s esperando o XLSX parcial
+app.config['MASSA_PARCIAL_VALIDADE'] = float(os.environ.get('MASSA_PARCIAL_VALIDADE', 5))   # s reaproveitando o último parcial
+app.config['COMPRESSAO_MIN_BYTES'] = int(os.environ.get('COMPRESSAO_MIN_BYTES', 1024))
+
+# Perfilamento opcional: PERFIL=1 (tudo) ou header X-Perfil com PERFIL_TOKEN (só aquela requisição/job)
+app.config['PERFIL_ATIVO'] = os.environ.get('PERFIL') == '1'
+app.config['PERFIL_TOKEN'] = os.environ.get('PERFIL_TOKEN')
+app.config['PERFIL_DIR'] = os.environ.get('PERFIL_DIR', os.path.join('Uploads', 'perfis'))
+app.config['PERFIL_LENTO_MS'] = int(os.environ.get('PERFIL_LENTO_MS', 2000))  # acima disso as etapas vão para o log em INFO
 
 # API Configuration
 app.config['TOKEN_API'] = os.environ.get('TOKEN_API')
 app.config['URL_API'] = os.environ.get('URL_API')
+# Pool de tokens: TOKENS_API="tokA|10,tokB|5" (token|chamadas por segundo); ver tokens_frete.py
+app.config['TOKENS_API'] = tokens_frete.ler_config(os.environ.get('TOKENS_API'), app.config['TOKEN_API'])
+if app.config['TOKENS_API'] and not app.config['TOKEN_API']:
+    app.config['TOKEN_API'] = app.config['TOKENS_API'][0][0]
+tokens_frete.pool.configurar(app.config['TOKENS_API'])
+app.config['COTAR_MAX_CONTRATOS'] = int(os.environ.get('COTAR_MAX_CONTRATOS', 10))  # contratos por /cotar
+app.config['RELATORIOS_LOTE_MAX'] = int(os.environ.get('RELATORIOS_LOTE_MAX', 5000))  # ids por mudança de status em lote
+
+# Tabela de rotas frequentes do /cotar (cotações pré-calculadas)
+app.config['ROTAS_FRESCOR_SEGUNDOS'] = int(os.environ.get('ROTAS_FRESCOR_SEGUNDOS', 900))
+app.config['ROTAS_MAX'] = int(os.environ.get('ROTAS_MAX', 50))
+app.config['ROTAS_ORCAMENTO_POR_MINUTO'] = int(os.environ.get('ROTAS_ORCAMENTO_POR_MINUTO', 6))  # 0 desliga a atualização
+app.config['ROTAS_MIN_CONSULTAS'] = int(os.environ.get('ROTAS_MIN_CONSULTAS', 3))
+
+# Cotação em massa: limites do controle adaptativo de concorrência (AIMD)
+app.config['MASSA_CONCORRENCIA_INICIAL'] = int(os.environ.get('MASSA_CONCORRENCIA_INICIAL', 2))
+app.config['MASSA_CONCORRENCIA_MIN'] = int(os.environ.get('MASSA_CONCORRENCIA_MIN', 1))
+app.config['MASSA_CONCORRENCIA_MAX'] = int(os.environ.get('MASSA_CONCORRENCIA_MAX', 16))
+app.config['MASSA_LATENCIA_PICO_FATOR'] = float(os.environ.get('MASSA_LATENCIA_PICO_FATOR', 2.0))
 
 # Validar configurações
 if not app.config['TOKEN_API'] or not app.config['URL_API']:
@@ -53,29 +108,69 @@ if not app.config['TOKEN_API'] or not app.config['URL_API']:
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)  # Garante que a pasta Uploads exista
 
+perfil.registrar(app)      # etapas no log/Server-Timing e cProfile opcional
+compressao.registrar(app)  # gzip/br + ETag/304
+
 # ---------------------------------------------------------------------
 # Armazenamento em memória (demo)
 # ---------------------------------------------------------------------
 cotacoes_selecionadas = []
 solicitacoes_coleta = []
+# Armazenamento em memória, por processo: o gunicorn.conf.py usa um worker web por padrão.
+# Com WEB_CONCURRENCY > 1 cada worker tem a própria lista, e o lock, os contadores e os
+# lotes de /relatorios/status valem só para ela.
+solicitacoes_por_id = {}      # id -> solicitação (os mesmos dicts da lista)
+contagem_status = Counter()   # status -> quantidade, ajustada a cada inclusão/mudança
+_lock_coletas = threading.Lock()  # inclusões e mudanças de status (um lote é uma transação)
+tabela_rotas = TabelaRotas(
+    frescor=app.config['ROTAS_FRESCOR_SEGUNDOS'],
+    max_rotas=app.config['ROTAS_MAX'],
+    # Cada worker web atualiza a própria tabela: o orçamento configurado é dividido entre eles
+    orcamento_por_minuto=app.config['ROTAS_ORCAMENTO_POR_MINUTO'] / max(1, int(os.environ.get('WEB_CONCURRENCY', 1))),
+    min_consultas=app.config['ROTAS_MIN_CONSULTAS'],
+)
 
 # ---------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------
 ALLOWED_STATUSES = {"solicitacao", "transito", "pendencia", "entregue"}
+ORDEM_STATUS = ("solicitacao", "transito", "pendencia", "entregue")
+_SINONIMOS_STATUS = {
+    "solicitação de coleta": "solicitacao",
+    "solicitação": "solicitacao",
+    "solicitacao de coleta": "solicitacao",
+    "trânsito": "transito",
+    "pendência": "pendencia",
+    "pendente": "pendencia",
+}
+
+def _status_conhecido(s: str):
+    """Status normalizado, ou None se não for um dos conhecidos."""
+    s = (s or "").strip().lower()
+    s = _SINONIMOS_STATUS.get(s, s)
+    return s if s in ALLOWED_STATUSES else None
 
 def _normalize_status(s: str) -> str:
-    s = (s or "").strip().lower()
-    mapa = {
-        "solicitação de coleta": "solicitacao",
-        "solicitação": "solicitacao",
-        "solicitacao de coleta": "solicitacao",
-        "trânsito": "transito",
-        "pendência": "pendencia",
-        "pendente": "pendencia",
-    }
-    s = mapa.get(s, s)
-    return s if s in ALLOWED_STATUSES else "solicitacao"
+    return _status_conhecido(s) or "solicitacao"
+
+def _registrar_solicitacao(s: dict):
+    with _lock_coletas:
+        solicitacoes_coleta.append(s)
+        solicitacoes_por_id[s["id"]] = s
+        contagem_status[_normalize_status(s.get("status"))] += 1
+
+def _mudar_status(s: dict, novo: str) -> bool:
+    """Troca o status e ajusta os contadores (chamar com _lock_coletas). False se já estava nele."""
+    atual = _normalize_status(s.get("status"))
+    s["status"] = novo
+    if atual == novo:
+        return False
+    contagem_status[atual] -= 1
+    contagem_status[novo] += 1
+    return True
+
+def _contagem() -> dict:
+    return {st: contagem_status.get(st, 0) for st in ORDEM_STATUS}
 
 def limpar_cnpj(cnpj):
     """Remove todos os caracteres não numéricos."""
@@ -206,9 +301,130 @@ def cotacoes_alias():
 # ---------------------------------------------------------------------
 # Cotação individual
 # ---------------------------------------------------------------------
+def _contratos_da_requisicao() -> list:
+    """
+    Contratos/segmentos pedidos em /cotar: campo `id_contrato_transportadora_segmento`
+    repetido e/ou separado por vírgulas. Sem o campo, usa o contrato "1". O limite de
+    COTAR_MAX_CONTRATOS é conferido pelo /cotar (400), não aplicado aqui em silêncio.
+    """
+    ids = []
+    for bruto in request.form.getlist("id_contrato_transportadora_segmento"):
+        for parte in str(bruto).split(","):
+            parte = parte.strip()
+            if parte and parte not in ids:
+                ids.append(parte)
+    return ids or ["1"]
+
+def _consultar_contrato(url_api: str, token: str, payload: dict, contrato: str, classe=despacho.INTERATIVO):
+    """Consulta a API de fretes para um contrato. Retorna (data, mensagem_de_erro)."""
+    corpo = {"id_contrato_transportadora_segmento": contrato, **payload}
+    # >>> ENVIA EXATAMENTE O QUE ESTÁ NO .ENV (sem forçar 'Bearer ')
+    headers = {"Authorization": token, "Content-Type": "application/json"}
+
+    try:
+        logger.info(f"POST {url_api} headers={{'Authorization': '***masked***', 'Content-Type': 'application/json'}} payload={corpo}")
+        resp = cliente_frete.post(url_api, headers=headers, json=corpo, timeout=30,
+                                  classe=classe, dono="tabela_rotas" if classe == despacho.MASSA else None)
+        logger.info(f"API status={resp.status_code} (contrato {contrato})")
+        logger.info(f"API raw text (primeiros 500): {resp.text[:500]}")
+        resp.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logger.exception(f"Falha HTTP ao chamar API de frete (contrato {contrato})")
+        return None, f"Erro na comunicação com o sistema de fretes: {str(e)}"
+
+    try:
+        data = cliente_frete.ler_json(resp)
+    except ValueError:
+        logger.error("Resposta não é JSON. Veja 'API raw text' acima.")
+        return None, "A API retornou um conteúdo não-JSON. Verifique TOKEN_API/URL_API."
+
+    logger.info(f"Resposta JSON da API (contrato {contrato}): {data}")
+    return data, None
+
+def _cotar_payload(url_api: str, token: str, payload: dict, contratos: list, classe=despacho.INTERATIVO):
+    """
+    Cota o payload em todos os contratos e mescla as opções.
+    Retorna (corpo_da_resposta, status_http) no formato do /cotar.
+    `classe`: vez no despachante (a atualização da tabela de rotas vai como massa).
+    """
+    produtos = payload["produtos"]
+    # Um contrato consulta direto; vários são disparados em paralelo
+    if len(contratos) == 1:
+        respostas = [_consultar_contrato(url_api, token, payload, contratos[0], classe)]
+    else:
+        with ThreadPoolExecutor(max_workers=len(contratos)) as executor:
+            respostas = list(executor.map(
+                lambda c: _consultar_contrato(url_api, token, payload, c, classe), contratos))
+
+    opcoes, vistas, erros, mensagens = [], set(), [], []
+    for contrato, (data, erro) in zip(contratos, respostas):
+        if erro:
+            erros.append({"contrato": contrato, "mensagem": erro})
+            continue
+        if not isinstance(data, dict) or not data.get("resultado"):
+            if isinstance(data, dict) and data.get("mensagem"):
+                mensagens.append(data["mensagem"])
+            continue
+        for o in data["resultado"]:
+            if not isinstance(o, dict):
+                continue
+            opcao = {
+                "transportadora": o.get("transportadora", "Transportadora não especificada"),
+                "total": float(o.get("total", 0) or 0),
+                "prazo": o.get("prazo", "N/A"),
+                "servico": o.get("servico", "Padrão"),
+                "imagem": o.get("imagem", ""),
+                "integrador": o.get("integrador", ""),
+                "observacao": o.get("observacao", ""),
+                "contrato": contrato
+            }
+            # A mesma oferta vinda por dois contratos aparece uma vez só (fica o primeiro)
+            chave = tuple(str(opcao[k]) for k in ("transportadora", "integrador", "servico", "prazo", "total"))
+            if chave in vistas:
+                continue
+            vistas.add(chave)
+            opcoes.append(opcao)
+
+    if opcoes:
+        resposta = {
+            "status": "sucesso",
+            "opcoes": opcoes,
+            "dados_entrega": {
+                "valor_total_carga": sum(float(p["valor"]) for p in produtos),
+                "peso_total": sum(float(p["peso"]) for p in produtos),
+                "quantidade_total": sum(int(p["quantidade"]) for p in produtos)
+            }
+        }
+        if erros:
+            resposta["contratos_com_erro"] = erros
+        return resposta, 200
+
+    if erros and len(erros) == len(contratos):
+        return {"status": "erro", "mensagem": erros[0]["mensagem"], "contratos_com_erro": erros}, 502
+
+    return {
+        "status": "sem_resultado",
+        "mensagem": (mensagens[0] if mensagens else None) or
+                    "Nenhuma transportadora disponível para esta rota"
+    }, 200
+
+def _cotar_para_tabela(payload: dict, contratos: list):
+    """
+    Cotador usado pela atualização em segundo plano da tabela de rotas. Resposta com
+    contratos_com_erro (mescla parcial) não é guardada: a falha de um contrato ficaria
+    servida pela tabela durante todo o frescor.
+    """
+    resposta, _ = _cotar_payload(app.config['URL_API'], app.config['TOKEN_API'], payload, contratos, despacho.MASSA)
+    if resposta["status"] != "sucesso" or resposta.get("contratos_com_erro"):
+        return None
+    return resposta
+
 @app.post("/cotar")
 def cotar():
-    """Endpoint de cotação de frete (individual)."""
+    """
+    Endpoint de cotação de frete (individual).
+    Aceita um ou vários contratos/segmentos; as opções vêm mescladas e marcadas com `contrato`.
+    """
     try:
         TOKEN_API = app.config.get('TOKEN_API')
         URL_API = app.config.get('URL_API')
@@ -216,7 +432,8 @@ def cotar():
         if not TOKEN_API or not URL_API:
             return jsonify({"status": "erro", "mensagem": "TOKEN_API ou URL_API não configurado no ambiente."}), 500
 
-        dados = request.form.to_dict()
+        with perfil.etapa("formulario"):
+            dados = request.form.to_dict()
         logger.info(f"Dados recebidos: {dados}")
 
         # Validação mínima
@@ -228,6 +445,7 @@ def cotar():
             return jsonify({"status": "erro", "mensagem": msg}), 400
 
         # Processa pacotes
+        inicio_payload = time.perf_counter()
         produtos = []
         i = 0
         while True:
@@ -258,7 +476,6 @@ def cotar():
             i += 1
 
         payload = {
-            "id_contrato_transportadora_segmento": "1",
             "cnpj_origem": limpar_cnpj(dados["cnpj_origem"]),
             "cep_origem": dados["cep_origem"],
             "estado_origem": dados.get("estado_origem", "SC"),
@@ -269,57 +486,32 @@ def cotar():
             "cidade_destino": dados.get("cidade_destino", ""),
             "produtos": produtos
         }
+        perfil.registrar_etapa("payload", time.perf_counter() - inicio_payload)
 
-        # >>> ENVIA EXATAMENTE O QUE ESTÁ NO .ENV (sem forçar 'Bearer ')
-        headers = {"Authorization": TOKEN_API, "Content-Type": "application/json"}
-
-        try:
-            logger.info(f"POST {URL_API} headers={{'Authorization': '***masked***', 'Content-Type': 'application/json'}} payload={payload}")
-            resp = requests.post(URL_API, headers=headers, json=payload, timeout=30)
-            logger.info(f"API status={resp.status_code}")
-            logger.info(f"API raw text (primeiros 500): {resp.text[:500]}")
-            resp.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            logger.exception("Falha HTTP ao chamar API de frete")
-            return jsonify({"status": "erro", "mensagem": f"Erro na comunicação com o sistema de fretes: {str(e)}"}), 502
-
-        try:
-            data = resp.json()
-        except ValueError:
-            logger.error("Resposta não é JSON. Veja 'API raw text' acima.")
-            return jsonify({
-                "status": "erro",
-                "mensagem": "A API retornou um conteúdo não-JSON. Verifique TOKEN_API/URL_API."
-            }), 502
-
-        logger.info(f"Resposta JSON da API: {data}")
-
-        if isinstance(data, dict) and "resultado" in data:
-            todas = data.get("resultado") or []
-            if todas:
-                return jsonify({
-                    "status": "sucesso",
-                    "opcoes": [{
-                        "transportadora": o.get("transportadora", "Transportadora não especificada"),
-                        "total": float(o.get("total", 0) or 0),
-                        "prazo": o.get("prazo", "N/A"),
-                        "servico": o.get("servico", "Padrão"),
-                        "imagem": o.get("imagem", ""),
-                        "integrador": o.get("integrador", ""),
-                        "observacao": o.get("observacao", "")
-                    } for o in todas],
-                    "dados_entrega": {
-                        "valor_total_carga": sum(float(p["valor"]) for p in produtos),
-                        "peso_total": sum(float(p["peso"]) for p in produtos),
-                        "quantidade_total": sum(int(p["quantidade"]) for p in produtos)
-                    }
-                })
+        contratos = _contratos_da_requisicao()
+        if len(contratos) > app.config['COTAR_MAX_CONTRATOS']:
+            msg = (f"Máximo de {app.config['COTAR_MAX_CONTRATOS']} contratos por cotação "
+                   f"({len(contratos)} enviados)")
+            logger.error(msg)
+            return jsonify({"status": "erro", "mensagem": msg}), 400
 
-        return jsonify({
-            "status": "sem_resultado",
-            "mensagem": (data.get("mensagem") if isinstance(data, dict) else None) or
-                        "Nenhuma transportadora disponível para esta rota"
-        })
+        # Rotas frequentes: responde da tabela enquanto a cotação estiver fresca
+        chave = chave_rota(payload, contratos)
+        guardada = tabela_rotas.consultar(chave, payload, contratos)
+        if guardada is not None:
+            resposta, cotado_em = guardada
+            logger.info(f"/cotar respondido pela tabela de rotas (cotado_em={formatar_cotado_em(cotado_em)})")
+            return jsonify({**resposta, "cotado_em": formatar_cotado_em(cotado_em), "origem_cotacao": "tabela_rotas"})
+
+        with perfil.etapa("upstream"):
+            resposta, http_status = _cotar_payload(URL_API, TOKEN_API, payload, contratos)
+        if resposta["status"] == "sucesso":
+            agora = time.time()
+            if not resposta.get("contratos_com_erro"):  # parcial não vai para a tabela
+                tabela_rotas.armazenar(chave, resposta, agora)
+            resposta = {**resposta, "cotado_em": formatar_cotado_em(agora), "origem_cotacao": "api"}
+        tabela_rotas.iniciar(_cotar_para_tabela)
+        return jsonify(resposta), http_status
 
     except Exception as e:
         logger.exception("Erro interno no /cotar")
@@ -377,9 +569,193 @@ def limpar_selecionadas():
 # ---------------------------------------------------------------------
 # Relatórios
 # ---------------------------------------------------------------------
+def _filtrar_solicitacoes(args):
+    """
+    Filtros do relatório (mesmos da página): status, texto livre (q) e
+    intervalo de datas do registro (de/ate no formato AAAA-MM-DD). Gera sob demanda.
+    """
+    status = _normalize_status(args.get("status")) if args.get("status") else ""
+    texto = (args.get("q") or "").strip().lower()
+    de = (args.get("de") or "").strip()
+    ate = (args.get("ate") or "").strip()
+    for s in solicitacoes_coleta:
+        if status and _normalize_status(s.get("status")) != status:
+            continue
+        dia = (s.get("timestamp") or "")[:10]
+        if (de and dia < de) or (ate and dia > ate):
+            continue
+        if texto and texto not in json.dumps(
+                {k: v for k, v in s.items() if k != "xml_content"}, ensure_ascii=False, default=str).lower():
+            continue
+        yield s
+
+COLUNAS_EXPORTACAO = [
+    "id", "timestamp", "status", "observacoes", "xml_filename", "cotacao_id",
+    "nf_numero", "nf_serie", "nf_data_emissao", "nf_valor",
+    "origem_nome", "origem_cnpj", "origem_cep", "origem_cidade", "origem_uf",
+    "destino_nome", "destino_cnpj", "destino_cep", "destino_cidade", "destino_uf",
+    "cotacao_transportadora", "cotacao_servico", "cotacao_prazo", "cotacao_total",
+    "cotacao_integrador", "cotacao_contrato",
+]
+
+def _achatar_solicitacao(s: dict) -> list:
+    """Uma solicitação → valores na ordem de COLUNAS_EXPORTACAO (nfe_info e cotacao achatados)."""
+    nf = s.get("nfe_info") or {}
+    origem = nf.get("origem") or {}
+    destino = nf.get("destino") or {}
+    cot = s.get("cotacao") or {}
+    return [
+        s.get("id", ""), s.get("timestamp", ""), _normalize_status(s.get("status")),
+        s.get("observacoes") or "", s.get("xml_filename", ""), s.get("cotacao_id") or "",
+        nf.get("numero", ""), nf.get("serie", ""), nf.get("data_emissao", ""), nf.get("valor_nf", ""),
+        origem.get("nome", ""), origem.get("cnpj", ""), origem.get("cep", ""), origem.get("cidade", ""), origem.get("uf", ""),
+        destino.get("nome", ""), destino.get("cnpj", ""), destino.get("cep", ""), destino.get("cidade", ""), destino.get("uf", ""),
+        cot.get("transportadora", ""), cot.get("servico", ""), cot.get("prazo", ""), cot.get("total", ""),
+        cot.get("integrador", ""), cot.get("contrato", ""),
+    ]
+
+def _gerar_csv(solicitacoes):
+    buffer = StringIO()
+    escritor = csv.writer(buffer)
+    yield "\ufeff"  # BOM para o Excel reconhecer UTF-8
+    escritor.writerow(COLUNAS_EXPORTACAO)
+    for s in solicitacoes:
+        escritor.writerow(_achatar_solicitacao(s))
+        if buffer.tell() >= 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def _gerar_xlsx(solicitacoes, tamanho_bloco=64 * 1024):
+    """XLSX em modo write_only (linhas vão para disco) e envio do arquivo em blocos."""
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Relatorio")
+    ws.append(COLUNAS_EXPORTACAO)
+    for s in solicitacoes:
+        ws.append(_achatar_solicitacao(s))
+    with tempfile.TemporaryFile() as tmp:
+        wb.save(tmp)
+        tmp.seek(0)
+        while True:
+            bloco = tmp.read(tamanho_bloco)
+            if not bloco:
+                break
+            yield bloco
+
 @app.get("/relatorios")
 def relatorios():
-    return render_template("relatorios.html", solicitacoes=solicitacoes_coleta)
+    return render_template("relatorios.html", solicitacoes=list(_filtrar_solicitacoes(request.args)))
+
+@app.get("/relatorios/exportar")
+def exportar_relatorios():
+    """Exporta as solicitações de coleta (CSV ou XLSX) em streaming, com os filtros do relatório."""
+    formato = (request.args.get("formato") or "csv").lower()
+    solicitacoes = _filtrar_solicitacoes(request.args.to_dict())
+    nome = f"relatorio_coletas_{datetime.now().strftime('%Y%m%d_%H%M')}"
+    if formato == "xlsx":
+        return Response(
+            _gerar_xlsx(solicitacoes),
+            mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            headers={"Content-Disposition": f"attachment; filename={nome}.xlsx"}
+        )
+    if formato != "csv":
+        return jsonify({"status": "erro", "mensagem": "Formato inválido (use csv ou xlsx)"}), 400
+    return Response(
+        _gerar_csv(solicitacoes),
+        mimetype="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f"attachment; filename={nome}.csv"}
+    )
+
+@app.get("/relatorios/contagem")
+def contagem_relatorios():
+    """Quantidade de solicitações por status (contadores mantidos a cada mudança)."""
+    return jsonify(_contagem())
+
+@app.post("/relatorios/status")
+def atualizar_status_lote():
+    """
+    Muda o status de várias solicitações de uma vez, numa transação (ninguém vê o lote
+    pela metade). Corpo JSON:
+      {"status": "transito", "ids": ["...", ...]}
+      {"status": "transito", "filtro": {"status": "solicitacao", "q": "...", "de": "AAAA-MM-DD", "ate": "..."}}
+    O filtro é o do servidor (relatório/exportação): "q" procura no registro inteiro,
+    não só no texto das colunas da página — por isso a página manda os ids das linhas
+    visíveis. No lote o filtro é estrito: status desconhecido ou data fora de AAAA-MM-DD
+    dão 400, e um filtro sem critérios (que pegaria tudo) só vale com "todas": true.
+    Com "tudo_ou_nada": true, um id inexistente cancela o lote (409). Devolve
+    o resultado por id (atualizado, inalterado, nao_encontrado), o resumo e os
+    contadores por status. A transação e os contadores são do processo (ver acima).
+    """
+    try:
+        payload = request.get_json(silent=True) or {}
+        if not isinstance(payload, dict):
+            return jsonify({"status": "erro", "mensagem": "Corpo deve ser um objeto JSON"}), 400
+        status = payload.get("status")
+        # Sem o fallback do _normalize_status: um status digitado errado não pode virar 'solicitacao' em lote
+        novo_status = _status_conhecido(status) if isinstance(status, str) else None
+        if novo_status is None:
+            return jsonify({"status": "erro", "mensagem": f"Status inválido (use {', '.join(ORDEM_STATUS)})"}), 400
+        ids, filtro = payload.get("ids"), payload.get("filtro")
+        if (ids is None) == (filtro is None):
+            return jsonify({"status": "erro", "mensagem": "Envie 'ids' (lista) ou 'filtro' (objeto), um dos dois"}), 400
+        if ids is not None:
+            if not isinstance(ids, list) or not all(isinstance(i, str) for i in ids):
+                return jsonify({"status": "erro", "mensagem": "'ids' deve ser uma lista de ids"}), 400
+            ids = list(dict.fromkeys(ids))
+            if len(ids) > app.config['RELATORIOS_LOTE_MAX']:
+                return jsonify({"status": "erro",
+                                "mensagem": f"Máximo de {app.config['RELATORIOS_LOTE_MAX']} ids por lote"}), 413
+        elif not isinstance(filtro, dict):
+            return jsonify({"status": "erro", "mensagem": "'filtro' deve ser um objeto"}), 400
+        else:
+            invalidos = [k for k in ("status", "q", "de", "ate") if k in filtro and not isinstance(filtro[k], str)]
+            if invalidos:
+                return jsonify({"status": "erro",
+                                "mensagem": f"Filtro inválido: os campos precisam ser texto ({', '.join(invalidos)})"}), 400
+            filtro = {k: filtro[k].strip() for k in ("status", "q", "de", "ate") if (filtro.get(k) or "").strip()}
+            # Aqui também sem o fallback: "transto" viraria 'solicitacao' e o lote pegaria as linhas erradas
+            if "status" in filtro:
+                filtro["status"] = _status_conhecido(filtro["status"])
+                if filtro["status"] is None:
+                    return jsonify({"status": "erro", "mensagem": "Filtro inválido: status desconhecido "
+                                                                  f"(use {', '.join(ORDEM_STATUS)})"}), 400
+            datas = [k for k in ("de", "ate") if k in filtro and not re.fullmatch(r"\d{4}-\d{2}-\d{2}", filtro[k])]
+            if datas:
+                return jsonify({"status": "erro",
+                                "mensagem": f"Filtro inválido: datas no formato AAAA-MM-DD ({', '.join(datas)})"}), 400
+            if not filtro and payload.get("todas") is not True:
+                return jsonify({"status": "erro", "mensagem": "Filtro sem critérios alteraria todas as "
+                                                              "solicitações; envie \"todas\": true para confirmar"}), 400
+
+        with perfil.etapa("lote_status"), _lock_coletas:
+            if ids is not None:
+                alvos = [(i, solicitacoes_por_id.get(i)) for i in ids]
+                faltando = [i for i, s in alvos if s is None]
+                if faltando and payload.get("tudo_ou_nada"):
+                    return jsonify({"status": "erro", "mensagem": "Solicitações não encontradas; nada foi alterado",
+                                    "nao_encontrados": faltando, "contagem": _contagem()}), 409
+            else:
+                alvos = [(s["id"], s) for s in _filtrar_solicitacoes(filtro)]
+            resultados = {}
+            for solicitacao_id, s in alvos:
+                if s is None:
+                    resultados[solicitacao_id] = "nao_encontrado"
+                else:
+                    resultados[solicitacao_id] = "atualizado" if _mudar_status(s, novo_status) else "inalterado"
+            contagem = _contagem()
+
+        return jsonify({
+            "status": "sucesso",
+            "novo_status": novo_status,
+            "resultados": resultados,
+            "resumo": dict(Counter(resultados.values())),
+            "contagem": contagem,
+        })
+    except Exception as e:
+        logger.exception("Erro ao atualizar status em lote")
+        return jsonify({"status": "erro", "mensagem": f"Erro ao atualizar status: {str(e)}"}), 500
 
 @app.post("/relatorios/<solicitacao_id>/status")
 def atualizar_status(solicitacao_id):
@@ -387,12 +763,14 @@ def atualizar_status(solicitacao_id):
     try:
         payload = request.get_json(silent=True) or {}
         novo_status = _normalize_status(payload.get("status"))
-        s = next((x for x in solicitacoes_coleta if x.get('id') == solicitacao_id), None)
+        s = solicitacoes_por_id.get(solicitacao_id)
         if not s:
             return jsonify({"status": "erro", "mensagem": "Solicitação não encontrada"}), 404
 
-        s["status"] = novo_status
-        return jsonify({"status": "sucesso", "novo_status": novo_status})
+        with _lock_coletas:
+            _mudar_status(s, novo_status)
+            contagem = _contagem()
+        return jsonify({"status": "sucesso", "novo_status": novo_status, "contagem": contagem})
     except Exception as e:
         logger.exception("Erro ao atualizar status")
         return jsonify({"status": "erro", "mensagem": f"Erro ao atualizar status: {str(e)}"}), 500
@@ -400,7 +778,7 @@ def atualizar_status(solicitacao_id):
 @app.get("/relatorios/<solicitacao_id>/xml")
 def visualizar_xml(solicitacao_id):
     try:
-        s = next((x for x in solicitacoes_coleta if x.get('id') == solicitacao_id), None)
+        s = solicitacoes_por_id.get(solicitacao_id)
         if not s:
             return "Solicitação não encontrada", 404
         return f"<pre>{s.get('xml_content','')}</pre>"
@@ -411,17 +789,17 @@ def visualizar_xml(solicitacao_id):
 @app.get("/relatorios/<solicitacao_id>/download")
 def download_xml(solicitacao_id):
     try:
-        s = next((x for x in solicitacoes_coleta if x.get('id') == solicitacao_id), None)
+        s = solicitacoes_por_id.get(solicitacao_id)
         if not s:
             return "Solicitação não encontrada", 404
 
-        xml_bytes = BytesIO(s.get('xml_content','').encode('utf-8'))
-        return send_file(
-            xml_bytes,
-            as_attachment=True,
-            download_name=s.get('xml_filename', 'documento.xml'),
-            mimetype='application/xml'
-        )
+        # Response comum (não send_file) para o XML passar pela compressão e pelo 304
+        xml_bytes = s.get('xml_content', '').encode('utf-8')
+        resp = Response(xml_bytes, mimetype='application/xml')
+        resp.headers.set("Content-Disposition", "attachment", filename=s.get('xml_filename', 'documento.xml'))
+        resp.headers["Cache-Control"] = "no-cache"
+        resp.set_etag(compressao.etag_de(xml_bytes))
+        return resp
     except Exception as e:
         logger.exception("Erro ao fazer download do XML")
         return f"Erro ao fazer download: {str(e)}", 500
@@ -471,7 +849,7 @@ def solicitar_coleta_alias():
             "status": "solicitacao",
             "timestamp": datetime.now().isoformat()
         }
-        solicitacoes_coleta.append(solicitacao)
+        _registrar_solicitacao(solicitacao)
 
         return jsonify({
             "status": "sucesso",
@@ -518,7 +896,7 @@ def _seed():
         "status": "pendencia",
         "timestamp": datetime.now().isoformat()
     }
-    solicitacoes_coleta.append(solic)
+    _registrar_solicitacao(solic)
 
     return jsonify({
         "ok": True,
@@ -544,6 +922,11 @@ else:
 # ---------------------------------------------------------------------
 # Rota de diagnóstico (listar rotas)
 # ---------------------------------------------------------------------
+@app.get("/_tabela_rotas")
+def _tabela_rotas():
+    """Situação da tabela de rotas frequentes do /cotar."""
+    return jsonify(tabela_rotas.snapshot())
+
 @app.get("/_routes")
 def _routes():
     """Lista de rotas para conferência rápida no navegador."""
@@ -558,5 +941,12 @@ def _routes():
 # ---------------------------------------------------------------------
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
+    # Cotação em massa roda em processos próprios (em produção, o gunicorn.conf.py os inicia).
+    # Só o processo do reloader sobe os workers, para não duplicá-los a cada reinício.
+    if massa_bp is not None and os.environ.get("WERKZEUG_RUN_MAIN") != "true" \
+            and os.environ.get("MASSA_WORKERS_EXTERNOS") != "1":
+        import atexit
+        import worker_massa
+        atexit.register(worker_massa.subir_processo().terminate)
     app.run(host='0.0.0.0', port=port, debug=True)
 
@@ -0,0 +1,93 @@
+"""
+Cliente HTTP compartilhado para a API de fretes.
+
+Uma única `requests.Session` por processo, com pool de conexões grande o
+suficiente para centenas de cotações simultâneas (workers gevent do gunicorn
+ou threads da cotação em massa) reaproveitando conexões keep-alive.
+Cada chamada pede a vez ao despachante (despacho.py): /cotar na frente, massa em rodízio.
+Com o pool de tokens ligado (tokens_frete.py), a credencial também é escolhida aqui.
+"""
+import codecs
+import os
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+import despacho
+import json_rapido
+import tokens_frete
+
+POOL_CONEXOES = int(os.environ.get('FRETE_POOL_CONEXOES', 200))
+
+def _criar_sessao(pool_maxsize=POOL_CONEXOES):
+    sessao = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+    sessao.mount("http://", adapter)
+    sessao.mount("https://", adapter)
+    return sessao
+
+sessao = _criar_sessao()
+
+def post(url, headers=None, json=None, timeout=30, classe=despacho.INTERATIVO, dono=None, etapas=None):
+    """
+    POST na API de fretes usando a sessão compartilhada, na vez dada pelo despachante.
+    `classe`: despacho.INTERATIVO ou despacho.MASSA; `dono`: quem reveza na massa (usuário/job).
+    Com `etapas` (perfil.Etapas), registra a espera na fila ("despacho"), a espera por
+    saldo de token ("token") e a chamada ("upstream").
+    """
+    espera = despacho.despachante.adquirir(classe, dono, timeout)
+    try:
+        if not tokens_frete.pool.ativo:
+            inicio = time.perf_counter()
+            try:
+                return sessao.post(url, headers=headers, json=json, timeout=timeout)
+            finally:
+                if etapas is not None:
+                    etapas.registrar("upstream", time.perf_counter() - inicio)
+        return _post_com_token(url, headers, json, timeout, classe, etapas)
+    finally:
+        despacho.despachante.liberar(classe)
+        if etapas is not None:
+            etapas.registrar("despacho", espera)
+
+def _post_com_token(url, headers, json, timeout, classe, etapas):
+    """
+    POST com o token de mais folga no pool (substitui o Authorization do chamador).
+    401/429 esfriam o token e a chamada é refeita com outro, enquanto houver um livre.
+    """
+    pool = tokens_frete.pool
+    tentativas = 0
+    while True:
+        inicio = time.perf_counter()
+        token = pool.adquirir(classe, timeout)
+        if etapas is not None:
+            etapas.registrar("token", time.perf_counter() - inicio)
+        inicio = time.perf_counter()
+        resp = None
+        try:
+            resp = sessao.post(url, headers={**(headers or {}), "Authorization": token.valor}, json=json,
+                               timeout=timeout)
+        finally:
+            pool.devolver(token, resp.status_code if resp is not None else None,
+                          resp.headers.get("Retry-After") if resp is not None else None)
+            if etapas is not None:
+                etapas.registrar("upstream", time.perf_counter() - inicio)
+        tentativas += 1
+        if resp.status_code not in (401, 429) or tentativas >= len(pool) or not pool.disponiveis():
+            return resp
+
+def ler_json(resp):
+    """
+    Decodifica o corpo da resposta (orjson quando disponível). Levanta ValueError se não for JSON.
+    Os bytes vão direto ao parser quando o upstream responde em UTF-8 (ou não declara
+    charset); com outro charset declarado (ex.: ISO-8859-1) decodifica antes pelo resp.text.
+    """
+    if resp.encoding and _codec(resp.encoding) not in ("utf-8", None):
+        return json_rapido.loads(resp.text)
+    return json_rapido.loads(resp.content)
+
+def _codec(nome):
+    try:
+        return codecs.lookup(nome).name
+    except LookupError:
+        return None  # charset desconhecido: os bytes seguem como UTF-8
@@ -0,0 +1,77 @@
+"""
+Compressão negociada (br/gzip) e GET condicional (ETag/304) para as respostas do app.
+
+- Comprime JSON/HTML/XML/texto acima de COMPRESSAO_MIN_BYTES, conforme o Accept-Encoding.
+  Brotli é usado quando o pacote `brotli` está instalado; senão, gzip.
+- Respostas com ETag (ex.: download de XML) respondem 304 quando o cliente já tem a
+  mesma representação. A ETag varia com a codificação para continuar forte.
+- Arquivos enviados com send_file (XLSX, já compactados) e respostas em streaming
+  passam direto; o ETag deles é tratado pelo próprio send_file.
+"""
+import gzip
+import hashlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+TIPOS_COMPRIMIVEIS = {
+    "application/json", "application/xml", "application/javascript", "image/svg+xml",
+}
+
+def etag_de(dados: bytes) -> str:
+    """ETag forte a partir do conteúdo."""
+    return hashlib.sha1(dados).hexdigest()
+
+def _comprimivel(response, minimo: int) -> bool:
+    if response.direct_passthrough or response.is_streamed:
+        return False
+    if response.status_code != 200 or "Content-Encoding" in response.headers:
+        return False
+    tipo = response.mimetype or ""
+    if not (tipo.startswith("text/") or tipo in TIPOS_COMPRIMIVEIS):
+        return False
+    return (response.content_length or 0) >= minimo
+
+def _negociar() -> str:
+    aceitas = request.accept_encodings
+    if brotli is not None and aceitas["br"]:
+        return "br"
+    if aceitas["gzip"]:
+        return "gzip"
+    return ""
+
+def registrar(app):
+    minimo = app.config.get("COMPRESSAO_MIN_BYTES", 1024)
+
+    @app.after_request
+    def _comprimir_e_validar(response):
+        if response.direct_passthrough or response.is_streamed:
+            return response
+
+        comprimivel = _comprimivel(response, minimo)
+        codificacao = _negociar() if comprimivel else ""
+
+        etag, fraca = response.get_etag()
+        if etag:
+            if codificacao:
+                response.set_etag(f"{etag}-{codificacao}", weak=fraca)
+            # Responde 304 antes de gastar CPU comprimindo
+            response.make_conditional(request)
+            if response.status_code == 304:
+                return response
+
+        if comprimivel:
+            response.vary.add("Accept-Encoding")
+        if codificacao:
+            dados = response.get_data()
+            if codificacao == "br":
+                dados = brotli.compress(dados, quality=5)
+            else:
+                dados = gzip.compress(dados, compresslevel=6)
+            response.set_data(dados)
+            response.headers["Content-Encoding"] = codificacao
+        return response
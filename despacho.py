@@ -0,0 +1,277 @@
+"""
+Despachante central das chamadas à API de fretes.
+
+Toda chamada passa por `cliente_frete.post`, que pede uma vaga aqui antes de ir ao
+upstream. Duas classes:
+- interativo (/cotar): prioridade estrita; enquanto houver cotação interativa na fila,
+  nenhuma chamada da massa é liberada;
+- massa (jobs em lote, cotar-em-massa, atualização da tabela de rotas): fica com o que
+  sobra, dividido em rodízio entre os donos (usuários/jobs), uma vaga por vez.
+
+O limite global é FRETE_MAX_CONCORRENCIA chamadas em voo, e FRETE_RESERVA_INTERATIVA
+delas nunca vai para a massa. Os workers web e os processos da massa (worker_massa.py)
+publicam a própria situação no SQLite da fila de jobs. Os workers web dividem o limite
+e a reserva entre os workers web vivos; os processos da massa leem a carga interativa
+deles e encolhem a própria parcela na mesma proporção. Quem espera uma vaga além do
+timeout da chamada recebe SemVagaDisponivel (um requests Timeout).
+A mesma sincronia divide o orçamento de chamadas/s do pool de tokens (tokens_frete.py)
+entre os processos.
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import requests
+
+import tokens_frete
+
+log = logging.getLogger(__name__)
+
+MAX_CONCORRENCIA = int(os.environ.get("FRETE_MAX_CONCORRENCIA", 32))
+RESERVA_INTERATIVA = int(os.environ.get("FRETE_RESERVA_INTERATIVA", 8))
+INTERVALO_SINCRONIA = 0.5   # s entre publicações/leituras no SQLite
+IDADE_MAX_SITUACAO = 3.0    # s; situação mais velha que isso é de processo que parou
+
+INTERATIVO = "interativo"
+MASSA = "massa"
+
+def _fora_do_hub(funcao, *args):
+    """
+    Executa I/O bloqueante (sqlite3) sem travar o worker gevent: lá a espera pelo lock
+    de escrita do SQLite (até 30 s, se um processo da massa estiver gravando) pararia o
+    hub e todas as requisições em voo; a chamada vai para o threadpool do gevent (thread
+    do SO) e só este greenlet espera. Fora do gevent, chama direto.
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return funcao(*args)
+    if not monkey.is_module_patched("threading"):
+        return funcao(*args)
+    import gevent
+    return gevent.get_hub().threadpool.apply(funcao, args)
+
+class SemVagaDisponivel(requests.exceptions.Timeout):
+    """A chamada esperou na fila do despachante mais que o próprio timeout."""
+
+class _Pedido:
+    __slots__ = ("evento", "inicio")
+
+    def __init__(self):
+        self.evento = threading.Event()
+        self.inicio = time.monotonic()
+
+class _Classe:
+    def __init__(self):
+        self.em_voo = 0
+        self.atendidas = 0
+        self.espera_ewma = None  # s
+        self.espera_max = 0.0
+
+    def atendida(self, espera, alfa=0.2):
+        self.atendidas += 1
+        self.espera_ewma = espera if self.espera_ewma is None else self.espera_ewma + alfa * (espera - self.espera_ewma)
+        self.espera_max = max(self.espera_max, espera)
+
+    def snapshot(self, fila):
+        return {
+            "em_voo": self.em_voo,
+            "fila": fila,
+            "atendidas": self.atendidas,
+            "espera_media_ms": round(self.espera_ewma * 1000, 1) if self.espera_ewma is not None else None,
+            "espera_max_ms": round(self.espera_max * 1000, 1),
+        }
+
+class Despachante:
+    def __init__(self, limite=MAX_CONCORRENCIA, reserva=RESERVA_INTERATIVA):
+        self.limite_global = max(1, int(limite))
+        self.reserva_global = min(max(0, int(reserva)), self.limite_global - 1)
+        self.papel = "web"
+        self.processos_massa = 1
+        # Até a primeira sincronia, supõe os workers web configurados no gunicorn
+        self._dividir_limite(int(os.environ.get("WEB_CONCURRENCY", 1)))
+        self.interativo_externo = 0      # chamadas interativas em voo/na fila nos workers web
+        self.situacao_interativa = None  # agregado dos workers web (só nos processos da massa)
+        self._interativo = _Classe()
+        self._massa = _Classe()
+        self._fila_interativa = deque()
+        self._filas_massa = {}           # dono -> deque de _Pedido
+        self._vez = deque()              # donos com pedido na fila, na ordem do rodízio
+        self._lock = threading.Lock()
+        self._sincronia = None
+
+    # --------------------------------------------------------
+    # Configuração
+    # --------------------------------------------------------
+    def configurar_massa(self, processos):
+        """Processo da massa: a parcela da massa é dividida entre `processos` processos."""
+        self.papel = "massa"
+        self.processos_massa = max(1, int(processos))
+        with self._lock:
+            self.limite, self.reserva = self.limite_global, self.reserva_global
+
+    def _dividir_limite(self, processos_web):
+        """Worker web: parcela do limite e da reserva globais (arredondada para baixo, mínimo 1)."""
+        self.processos_web = max(1, processos_web)
+        self.limite = max(1, self.limite_global // self.processos_web)
+        self.reserva = min(self.reserva_global // self.processos_web, self.limite - 1)
+
+    def limite_massa(self):
+        livres = self.limite - self.reserva - self.interativo_externo
+        return max(1, livres // self.processos_massa)
+
+    # --------------------------------------------------------
+    # Vagas
+    # --------------------------------------------------------
+    def adquirir(self, classe=INTERATIVO, dono=None, timeout=None):
+        """
+        Espera a vez desta chamada; devolve o tempo de espera (s). Sem vaga em `timeout` s,
+        desiste da fila e levanta SemVagaDisponivel.
+        """
+        self._garantir_sincronia()
+        pedido = _Pedido()
+        with self._lock:
+            if classe == INTERATIVO:
+                self._fila_interativa.append(pedido)
+            else:
+                fila = self._filas_massa.get(dono)
+                if fila is None:
+                    fila = self._filas_massa[dono] = deque()
+                    self._vez.append(dono)
+                fila.append(pedido)
+            self._distribuir()
+        if not pedido.evento.wait(timeout):
+            with self._lock:
+                if not pedido.evento.is_set():  # a vaga pode ter saído entre o wait e o lock
+                    self._desistir(classe, dono, pedido)
+                    raise SemVagaDisponivel(f"Sem vaga no despachante em {timeout:g}s ({classe})")
+        return time.monotonic() - pedido.inicio
+
+    def _desistir(self, classe, dono, pedido):
+        """Tira da fila um pedido que não foi atendido (chamado com o lock)."""
+        if classe == INTERATIVO:
+            self._fila_interativa.remove(pedido)
+            self._distribuir()  # sem interativo na fila, a massa pode voltar a andar
+            return
+        fila = self._filas_massa[dono]
+        fila.remove(pedido)
+        if not fila:
+            del self._filas_massa[dono]
+            self._vez.remove(dono)
+
+    def liberar(self, classe=INTERATIVO):
+        with self._lock:
+            c = self._interativo if classe == INTERATIVO else self._massa
+            c.em_voo = max(0, c.em_voo - 1)
+            self._distribuir()
+
+    def _liberar_pedido(self, classe, pedido):
+        classe.em_voo += 1
+        classe.atendida(time.monotonic() - pedido.inicio)
+        pedido.evento.set()
+
+    def _distribuir(self):
+        """Entrega as vagas livres: interativo primeiro; depois a massa, um dono por vez."""
+        while self._fila_interativa and self._interativo.em_voo + self._massa.em_voo < self.limite:
+            self._liberar_pedido(self._interativo, self._fila_interativa.popleft())
+        if self._fila_interativa:
+            return  # prioridade estrita: a massa espera
+        limite_massa = self.limite_massa()
+        while (self._vez and self._interativo.em_voo + self._massa.em_voo < self.limite
+               and self._massa.em_voo < limite_massa):
+            dono = self._vez.popleft()
+            fila = self._filas_massa[dono]
+            self._liberar_pedido(self._massa, fila.popleft())
+            if fila:
+                self._vez.append(dono)
+            else:
+                del self._filas_massa[dono]
+
+    # --------------------------------------------------------
+    # Situação
+    # --------------------------------------------------------
+    def snapshot(self):
+        with self._lock:
+            situacao = {
+                "limite": self.limite,
+                INTERATIVO: self._interativo.snapshot(len(self._fila_interativa)),
+                MASSA: {
+                    **self._massa.snapshot(sum(len(f) for f in self._filas_massa.values())),
+                    "limite": self.limite_massa(),
+                    "donos_na_fila": len(self._filas_massa),
+                },
+            }
+        if tokens_frete.pool.ativo:
+            situacao["tokens"] = tokens_frete.pool.snapshot()
+        if self.situacao_interativa is not None:
+            situacao[INTERATIVO] = self.situacao_interativa  # o que importa é a carga dos workers web
+        return situacao
+
+    def _garantir_sincronia(self):
+        if self._sincronia is not None:
+            return
+        with self._lock:
+            if self._sincronia is not None:
+                return
+            self._sincronia = threading.Thread(target=self._sincronizar, name="despacho", daemon=True)
+        # Fora do lock: com gevent, start() troca de greenlet e a sincronia usa o mesmo lock
+        self._sincronia.start()
+
+    def _sincronizar(self):
+        import fila_jobs
+        pid = os.getpid()
+        while True:
+            try:
+                situacao = self.snapshot()
+                _fora_do_hub(fila_jobs.publicar_despacho, pid, self.papel, situacao)
+                web = _fora_do_hub(fila_jobs.ler_despacho, "web", IDADE_MAX_SITUACAO)
+                if self.papel == "massa":
+                    self._ler_interativo(web)
+                else:
+                    with self._lock:
+                        self._dividir_limite(len(web))  # inclui este processo, recém-publicado
+                        self._distribuir()
+                if tokens_frete.pool.ativo:
+                    self._dividir_tokens(web)
+            except Exception:
+                log.exception("Falha ao sincronizar a situação do despachante")
+            time.sleep(INTERVALO_SINCRONIA)
+
+    def _dividir_tokens(self, web):
+        """
+        Parcela do orçamento dos tokens neste processo: os workers web dividem o total
+        entre si (o interativo pode usar tudo em rajada); cada processo da massa fica com
+        o que sobra da reserva interativa ou do uso real dos workers web, o que for maior.
+        """
+        pool = tokens_frete.pool
+        if self.papel == "web":
+            pool.definir_fracao(1.0 / max(1, len(web)))
+            return
+        fracao_web = 0.0
+        if web:
+            fracao_web = self.reserva / self.limite
+            orcamento = pool.orcamento_total()
+            if orcamento:
+                uso = sum(s.get("tokens", {}).get("taxa", 0.0) for s in web)
+                fracao_web = max(fracao_web, uso / orcamento)
+        pool.definir_fracao(max(0.05, 1.0 - fracao_web) / self.processos_massa)
+
+    def _ler_interativo(self, situacoes):
+        interativas = [s[INTERATIVO] for s in situacoes]
+        esperas = [s["espera_media_ms"] for s in interativas if s.get("espera_media_ms") is not None]
+        agregado = {
+            "em_voo": sum(s["em_voo"] for s in interativas),
+            "fila": sum(s["fila"] for s in interativas),
+            "atendidas": sum(s["atendidas"] for s in interativas),
+            "espera_media_ms": max(esperas) if esperas else None,
+            "espera_max_ms": max((s["espera_max_ms"] for s in interativas), default=0.0),
+            "workers_web": len(interativas),
+        }
+        with self._lock:
+            self.interativo_externo = agregado["em_voo"] + agregado["fila"]
+            self.situacao_interativa = agregado
+            self._distribuir()
+
+despachante = Despachante()
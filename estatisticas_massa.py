@@ -0,0 +1,194 @@
+"""
+Estatísticas incrementais da cotação em massa.
+
+Atualizadas a cada cotação concluída (sem reler os resultados):
+- por transportadora: min, média e p90 do `total`, média do R$/kg, faixa de prazo
+  e quantas linhas ela venceu (`melhor_opcao`);
+- por par de UF (origem→destino): min, média e p90 do frete vencedor e vitórias
+  por transportadora.
+O p90 usa o estimador P² (Jain & Chlamtac), com memória constante.
+"""
+import re
+import threading
+
+class QuantilP2:
+    """Estimativa de um quantil em fluxo com 5 marcadores (algoritmo P²)."""
+    def __init__(self, p):
+        self.p = p
+        self.q = []
+        self.pos = [1, 2, 3, 4, 5]
+        self.desejada = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.incremento = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def adicionar(self, x):
+        q, pos = self.q, self.pos
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = next(i for i in range(1, 5) if x < q[i]) - 1
+        for i in range(k + 1, 5):
+            pos[i] += 1
+        for i in range(5):
+            self.desejada[i] += self.incremento[i]
+
+        for i in range(1, 4):
+            d = self.desejada[i] - pos[i]
+            if (d >= 1 and pos[i + 1] - pos[i] > 1) or (d <= -1 and pos[i - 1] - pos[i] < -1):
+                d = 1 if d > 0 else -1
+                novo = self._parabolica(i, d)
+                if not q[i - 1] < novo < q[i + 1]:
+                    novo = q[i] + d * (q[i + d] - q[i]) / (pos[i + d] - pos[i])
+                q[i] = novo
+                pos[i] += d
+
+    def _parabolica(self, i, d):
+        q, n = self.q, self.pos
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def valor(self):
+        if not self.q:
+            return None
+        if len(self.q) < 5:
+            return self.q[int(round(self.p * (len(self.q) - 1)))]
+        return self.q[2]
+
+class Acumulador:
+    """min / média / p90 de uma série de valores."""
+    def __init__(self):
+        self.n = 0
+        self.soma = 0.0
+        self.minimo = None
+        self.p90 = QuantilP2(0.9)
+
+    def adicionar(self, x):
+        self.n += 1
+        self.soma += x
+        self.minimo = x if self.minimo is None else min(self.minimo, x)
+        self.p90.adicionar(x)
+
+    def resumo(self):
+        p90 = self.p90.valor()
+        return {
+            "n": self.n,
+            "min": round(self.minimo, 2) if self.minimo is not None else None,
+            "media": round(self.soma / self.n, 2) if self.n else None,
+            "p90": round(p90, 2) if p90 is not None else None,
+        }
+
+class _PorTransportadora:
+    def __init__(self):
+        self.total = Acumulador()
+        self.soma_preco_kg = 0.0
+        self.n_preco_kg = 0
+        self.prazo_min = None
+        self.prazo_max = None
+        self.vitorias = 0
+
+class _PorUF:
+    def __init__(self):
+        self.vencedor = Acumulador()
+        self.vitorias = {}
+
+def _prazo_dias(prazo):
+    m = re.search(r'\d+', str(prazo or ""))
+    return int(m.group()) if m else None
+
+def _peso(row):
+    try:
+        return float(str(row.get("peso", 0)).replace(",", "."))
+    except Exception:
+        return 0.0
+
+class EstatisticasMassa:
+    def __init__(self):
+        self.transportadoras = {}
+        self.ufs = {}
+        self.linhas = 0
+        self.linhas_com_cotacao = 0
+        self._lock = threading.Lock()
+
+    def registrar(self, row, opcoes):
+        """
+        Soma uma linha cotada. `row` é a linha da planilha (dict/Series) e `opcoes`
+        as `OpcaoFrete` da cotação (vazia se a linha não teve cotação).
+        """
+        validas = [o for o in opcoes if isinstance(o.total, (int, float)) and o.total >= 0]
+        melhor = min((o.total for o in validas), default=None)
+        peso = _peso(row)
+        par = f"{row.get('estado_origem') or '?'}→{row.get('estado_destino') or '?'}"
+
+        with self._lock:
+            self.linhas += 1
+            if melhor is None:
+                return
+            self.linhas_com_cotacao += 1
+
+            for o in validas:
+                t = self.transportadoras.get(o.transportadora)
+                if t is None:
+                    t = self.transportadoras[o.transportadora] = _PorTransportadora()
+                t.total.adicionar(o.total)
+                if peso > 0:
+                    t.soma_preco_kg += o.total / peso
+                    t.n_preco_kg += 1
+                dias = _prazo_dias(o.prazo)
+                if dias is not None:
+                    t.prazo_min = dias if t.prazo_min is None else min(t.prazo_min, dias)
+                    t.prazo_max = dias if t.prazo_max is None else max(t.prazo_max, dias)
+
+            uf = self.ufs.get(par)
+            if uf is None:
+                uf = self.ufs[par] = _PorUF()
+            uf.vencedor.adicionar(melhor)
+            # Empates contam para todas, igual à coluna `melhor_opcao`
+            for nome in {o.transportadora for o in validas if o.total == melhor}:
+                self.transportadoras[nome].vitorias += 1
+                uf.vitorias[nome] = uf.vitorias.get(nome, 0) + 1
+
+    def resumo_transportadoras(self):
+        with self._lock:
+            linhas = []
+            for nome, t in self.transportadoras.items():
+                linhas.append({
+                    "transportadora": nome,
+                    **{f"total_{k}": v for k, v in t.total.resumo().items()},
+                    "preco_kg_medio": round(t.soma_preco_kg / t.n_preco_kg, 2) if t.n_preco_kg else None,
+                    "prazo_min": t.prazo_min,
+                    "prazo_max": t.prazo_max,
+                    "vitorias": t.vitorias,
+                })
+        return sorted(linhas, key=lambda x: (-x["vitorias"], x["total_media"] or 0))
+
+    def resumo_ufs(self):
+        with self._lock:
+            linhas = []
+            for par, uf in self.ufs.items():
+                lider = max(uf.vitorias.items(), key=lambda kv: kv[1]) if uf.vitorias else ("", 0)
+                linhas.append({
+                    "uf_origem_destino": par,
+                    **{f"vencedor_{k}": v for k, v in uf.vencedor.resumo().items()},
+                    "transportadora_mais_vitorias": lider[0],
+                    "vitorias": lider[1],
+                    "vitorias_por_transportadora": dict(uf.vitorias),
+                })
+        return sorted(linhas, key=lambda x: -x["vencedor_n"])
+
+    def snapshot(self):
+        return {
+            "linhas": self.linhas,
+            "linhas_com_cotacao": self.linhas_com_cotacao,
+            "por_transportadora": self.resumo_transportadoras(),
+            "por_uf": self.resumo_ufs(),
+        }
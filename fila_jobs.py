@@ -0,0 +1,308 @@
+"""
+Fila de jobs da cotação em massa (SQLite), compartilhada entre os workers web do
+gunicorn e os processos de cotação (worker_massa.py).
+
+- A web só grava: cria o job, anexa linhas (upload em streaming), pede cancelamento
+  e lê o progresso. Nenhuma cotação roda no processo web.
+- Os processos de cotação reivindicam jobs pendentes, publicam progresso/métricas
+  periodicamente (que também servem de heartbeat) e gravam o XLSX em disco.
+"""
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+
+import json_rapido
+
+CAMINHO_DB = os.environ.get("MASSA_DB", os.path.join("Uploads", "massa_jobs.sqlite3"))
+PASTA_RESULTADOS = os.environ.get("MASSA_RESULTADOS_DIR", os.path.join("Uploads", "resultados"))
+HEARTBEAT_MAX = int(os.environ.get("MASSA_HEARTBEAT_MAX", 60))  # s sem atualizar → job órfão
+UPLOAD_PARADO_MAX = int(os.environ.get("MASSA_UPLOAD_PARADO_MAX", 300))  # s sem sinal do upload → job órfão
+
+STATUS_ATIVOS = ("pendente", "processando")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,                -- pendente | processando | concluido | erro | cancelado
+    origem TEXT NOT NULL,                -- xlsx | csv | ndjson
+    tipo_retorno TEXT NOT NULL,
+    dono TEXT,
+    arquivo_entrada TEXT,
+    nome_resultado TEXT,
+    arquivo_resultado TEXT,
+    etag TEXT,
+    total INTEGER NOT NULL DEFAULT 0,
+    atual INTEGER NOT NULL DEFAULT 0,
+    recebendo INTEGER NOT NULL DEFAULT 0,
+    cancelar INTEGER NOT NULL DEFAULT 0,
+    erro TEXT,
+    metricas TEXT,
+    estatisticas TEXT,
+    worker_pid INTEGER,
+    perfil INTEGER NOT NULL DEFAULT 0,   -- 1: gravar cProfile do job
+    parcial_pedido REAL,                 -- quando a web pediu um XLSX parcial (job em andamento)
+    parcial_em REAL,                     -- pedido atendido pelo último XLSX parcial gravado
+    recebido_em REAL,                    -- último sinal do upload em streaming (linhas ou backpressure)
+    criado_em REAL NOT NULL,
+    atualizado_em REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_status ON jobs(status, criado_em);
+CREATE INDEX IF NOT EXISTS ix_jobs_dono ON jobs(dono, criado_em);
+CREATE TABLE IF NOT EXISTS linhas (
+    job_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    dados TEXT NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+CREATE TABLE IF NOT EXISTS despacho (
+    pid INTEGER PRIMARY KEY,             -- processo (worker web ou da massa)
+    papel TEXT NOT NULL,                 -- web | massa
+    situacao TEXT NOT NULL,              -- snapshot do despacho.Despachante
+    atualizado_em REAL NOT NULL
+);
+"""
+
+# Colunas acrescentadas depois da primeira versão (bancos antigos ganham via ALTER TABLE)
+_COLUNAS_NOVAS = {
+    "perfil": "INTEGER NOT NULL DEFAULT 0",
+    "parcial_pedido": "REAL",
+    "parcial_em": "REAL",
+    "recebido_em": "REAL",
+}
+
+_schema_ok = False
+
+@contextmanager
+def conectar():
+    """Conexão curta por operação (seguro entre threads, greenlets e processos)."""
+    global _schema_ok
+    os.makedirs(os.path.dirname(CAMINHO_DB) or ".", exist_ok=True)
+    conn = sqlite3.connect(CAMINHO_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        if not _schema_ok:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            colunas = {r["name"] for r in conn.execute("PRAGMA table_info(jobs)")}
+            for coluna, tipo in _COLUNAS_NOVAS.items():
+                if coluna not in colunas:  # banco criado antes da coluna existir
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {coluna} {tipo}")
+            _schema_ok = True
+        conn.execute("PRAGMA synchronous=NORMAL")
+        yield conn
+    finally:
+        conn.close()
+
+def _dict(row):
+    if row is None:
+        return None
+    job = dict(row)
+    for campo in ("metricas", "estatisticas"):
+        job[campo] = json_rapido.loads(job[campo]) if job.get(campo) else {}
+    return job
+
+# ------------------------------------------------------------
+# Lado web
+# ------------------------------------------------------------
+def criar_job(origem, tipo_retorno, dono=None, arquivo_entrada=None, nome_resultado=None, recebendo=False,
+              perfil=False):
+    job_id = uuid.uuid4().hex
+    agora = time.time()
+    with conectar() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, status, origem, tipo_retorno, dono, arquivo_entrada, nome_resultado,"
+            " recebendo, perfil, recebido_em, criado_em, atualizado_em)"
+            " VALUES (?, 'pendente', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, origem, tipo_retorno, dono, arquivo_entrada, nome_resultado, int(recebendo), int(perfil),
+             agora, agora, agora)
+        )
+    return job_id
+
+def obter_job(job_id):
+    with conectar() as conn:
+        return _dict(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+def ultimo_job(dono=None):
+    with conectar() as conn:
+        if dono:
+            row = conn.execute("SELECT * FROM jobs WHERE dono = ? ORDER BY criado_em DESC LIMIT 1", (dono,)).fetchone()
+        else:
+            row = conn.execute("SELECT * FROM jobs ORDER BY criado_em DESC LIMIT 1").fetchone()
+    return _dict(row)
+
+def jobs_ativos(dono=None):
+    with conectar() as conn:
+        if dono:
+            rows = conn.execute("SELECT id FROM jobs WHERE dono = ? AND status IN ('pendente', 'processando')",
+                                (dono,)).fetchall()
+        else:
+            rows = conn.execute("SELECT id FROM jobs WHERE status IN ('pendente', 'processando')").fetchall()
+    return [r["id"] for r in rows]
+
+def pedir_cancelamento(job_id):
+    with conectar() as conn:
+        conn.execute("UPDATE jobs SET cancelar = 1 WHERE id = ?", (job_id,))
+        # Job que nenhum worker pegou ainda é cancelado direto
+        conn.execute("UPDATE jobs SET status = 'cancelado', recebendo = 0, atualizado_em = ?"
+                     " WHERE id = ? AND status = 'pendente' AND recebendo = 0", (time.time(), job_id))
+
+def pedir_parcial(job_id):
+    """Pede ao worker um XLSX com o que já foi cotado; devolve o instante do pedido."""
+    agora = time.time()
+    with conectar() as conn:
+        conn.execute("UPDATE jobs SET parcial_pedido = MAX(COALESCE(parcial_pedido, 0), ?) WHERE id = ?",
+                     (agora, job_id))
+    return agora
+
+def adicionar_linhas(job_id, primeira_seq, linhas):
+    """Anexa linhas (dicts) de um upload em streaming e atualiza o total."""
+    with conectar() as conn:
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO linhas (job_id, seq, dados) VALUES (?, ?, ?)",
+            [(job_id, primeira_seq + i, json_rapido.dumps(linha)) for i, linha in enumerate(linhas)]
+        )
+        conn.execute("UPDATE jobs SET total = total + ?, recebido_em = ? WHERE id = ?",
+                     (len(linhas), time.time(), job_id))
+        conn.execute("COMMIT")
+
+def sinalizar_recebimento(job_id):
+    """Upload vivo, só esperando a cotação (backpressure): o job não é órfão."""
+    with conectar() as conn:
+        conn.execute("UPDATE jobs SET recebido_em = ? WHERE id = ?", (time.time(), job_id))
+
+def finalizar_recebimento(job_id, erro=None):
+    with conectar() as conn:
+        if erro:
+            conn.execute("UPDATE jobs SET recebendo = 0, cancelar = 1, erro = ? WHERE id = ?", (erro, job_id))
+            # Nenhum worker pegou o job ainda: encerra aqui mesmo
+            conn.execute("UPDATE jobs SET status = 'erro', atualizado_em = ? WHERE id = ? AND status = 'pendente'",
+                         (time.time(), job_id))
+        else:
+            conn.execute("UPDATE jobs SET recebendo = 0 WHERE id = ?", (job_id,))
+
+# ------------------------------------------------------------
+# Lado worker
+# ------------------------------------------------------------
+def reivindicar_proximo(pid):
+    """Marca como 'processando' o job pendente mais antigo e o devolve (ou None)."""
+    agora = time.time()
+    with conectar() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Cancelado enquanto o upload em streaming ainda chegava
+            conn.execute("UPDATE jobs SET status = 'cancelado', atualizado_em = ?"
+                         " WHERE status = 'pendente' AND cancelar = 1 AND recebendo = 0", (agora,))
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE status = 'pendente' AND cancelar = 0 ORDER BY criado_em LIMIT 1"
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute("UPDATE jobs SET status = 'processando', worker_pid = ?, atualizado_em = ? WHERE id = ?",
+                         (pid, agora, row["id"]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return obter_job(row["id"])
+
+def recuperar_orfaos():
+    """
+    Encerra jobs que ninguém mais vai levar adiante: processo de cotação que parou de
+    publicar (heartbeat) e upload em streaming sem sinal há MASSA_UPLOAD_PARADO_MAX s
+    (worker web morto no meio do upload). Chamado periodicamente pelo worker_massa,
+    inclusive com todas as vagas ocupadas.
+    """
+    agora = time.time()
+    with conectar() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "UPDATE jobs SET status = 'erro', erro = 'Processo de cotação interrompido'"
+                " WHERE status = 'processando' AND atualizado_em < ?", (agora - HEARTBEAT_MAX,)
+            )
+            # Mesmo efeito do finalizar_recebimento com erro: o worker do job para de esperar linhas
+            conn.execute(
+                "UPDATE jobs SET recebendo = 0, cancelar = 1, erro = 'Upload interrompido',"
+                " status = CASE status WHEN 'pendente' THEN 'erro' ELSE status END,"
+                " atualizado_em = CASE status WHEN 'pendente' THEN ? ELSE atualizado_em END"
+                " WHERE recebendo = 1 AND status IN ('pendente', 'processando')"
+                " AND COALESCE(recebido_em, criado_em) < ?", (agora, agora - UPLOAD_PARADO_MAX)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+def publicar_progresso(job_id, **campos):
+    """
+    Atualiza campos do job (metricas/estatisticas em JSON) e o heartbeat.
+    Devolve (cancelar, recebendo, total, parcial_pedido) para o worker reagir.
+    """
+    for campo in ("metricas", "estatisticas"):
+        if campo in campos and not isinstance(campos[campo], str):
+            campos[campo] = json_rapido.dumps(campos[campo])
+    campos["atualizado_em"] = time.time()
+    sets = ", ".join(f"{k} = ?" for k in campos)
+    with conectar() as conn:
+        conn.execute(f"UPDATE jobs SET {sets} WHERE id = ?", (*campos.values(), job_id))
+        row = conn.execute("SELECT cancelar, recebendo, total, parcial_pedido FROM jobs WHERE id = ?",
+                           (job_id,)).fetchone()
+    return bool(row["cancelar"]), bool(row["recebendo"]), row["total"], row["parcial_pedido"]
+
+def ler_linhas(job_id, depois_de, limite=500):
+    """Linhas com seq > `depois_de` (limite=-1: todas)."""
+    with conectar() as conn:
+        rows = conn.execute(
+            "SELECT seq, dados FROM linhas WHERE job_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+            (job_id, depois_de, limite)
+        ).fetchall()
+    return [(r["seq"], json_rapido.loads(r["dados"])) for r in rows]
+
+def apagar_linhas(job_id, ate_seq=None):
+    with conectar() as conn:
+        if ate_seq is None:
+            conn.execute("DELETE FROM linhas WHERE job_id = ?", (job_id,))
+        else:
+            conn.execute("DELETE FROM linhas WHERE job_id = ? AND seq <= ?", (job_id, ate_seq))
+
+# ------------------------------------------------------------
+# Situação dos despachantes (ver despacho.py)
+# ------------------------------------------------------------
+def publicar_despacho(pid, papel, situacao):
+    agora = time.time()
+    with conectar() as conn:
+        conn.execute(
+            "INSERT INTO despacho (pid, papel, situacao, atualizado_em) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT(pid) DO UPDATE SET papel = excluded.papel, situacao = excluded.situacao,"
+            " atualizado_em = excluded.atualizado_em",
+            (pid, papel, json_rapido.dumps(situacao), agora)
+        )
+        conn.execute("DELETE FROM despacho WHERE atualizado_em < ?", (agora - 60,))
+
+def ler_despacho(papel, idade_max):
+    with conectar() as conn:
+        rows = conn.execute("SELECT situacao FROM despacho WHERE papel = ? AND atualizado_em >= ?",
+                            (papel, time.time() - idade_max)).fetchall()
+    return [json_rapido.loads(r["situacao"]) for r in rows]
+
+def limpar_antigos(horas):
+    """Remove jobs encerrados (e seus XLSX) com mais de `horas` horas."""
+    limite = time.time() - horas * 3600
+    with conectar() as conn:
+        rows = conn.execute(
+            "SELECT id, arquivo_resultado FROM jobs WHERE status NOT IN ('pendente', 'processando')"
+            " AND atualizado_em < ?", (limite,)
+        ).fetchall()
+        for r in rows:
+            if r["arquivo_resultado"]:
+                try:
+                    os.remove(r["arquivo_resultado"])
+                except OSError:
+                    pass
+            conn.execute("DELETE FROM linhas WHERE job_id = ?", (r["id"],))
+            conn.execute("DELETE FROM jobs WHERE id = ?", (r["id"],))
+    return len(rows)
@@ -0,0 +1,61 @@
+# Configuração do gunicorn (lida automaticamente por `gunicorn app:app`).
+#
+# /cotar passa quase todo o tempo esperando a API de fretes (até 30 s). Com o
+# worker gevent cada requisição roda num greenlet e a espera de rede não bloqueia
+# o processo: um único worker mantém centenas de cotações em voo, com o mesmo
+# contrato de requisição/resposta do worker síncrono.
+#
+# Um worker web por padrão: cotações selecionadas, solicitações de coleta (/relatorios)
+# e a tabela de rotas ficam em memória, por processo. Com WEB_CONCURRENCY > 1 cada
+# worker teria a própria cópia (relatórios pela metade, 404 ao mudar status).
+import os
+
+try:
+    import gevent  # noqa: F401
+    _worker_padrao = "gevent"
+except ImportError:
+    _worker_padrao = "sync"
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+worker_class = os.environ.get("WEB_WORKER_CLASS", _worker_padrao)
+worker_connections = int(os.environ.get("WEB_WORKER_CONNECTIONS", 500))
+# Acima do timeout de 30 s da API de fretes, para o worker não ser reciclado no meio da espera
+timeout = int(os.environ.get("WEB_TIMEOUT", 60))
+
+# MASSA_PRECARREGAR=1: o master importa o app (e pandas/openpyxl) antes do fork e os
+# workers herdam as páginas (copy-on-write). Com o worker gevent o monkey patch tem de
+# vir antes desse import: senão requests/ssl/threading do master são carregados sem
+# patch e os workers herdam locks e sockets bloqueantes. O worker gevent aplica o patch
+# de novo no fork, sem efeito.
+preload_app = os.environ.get("MASSA_PRECARREGAR") == "1"
+if preload_app and worker_class == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+
+# Cotação em massa roda em processos próprios (worker_massa.py), fora dos workers web.
+# Com MASSA_WORKERS_EXTERNOS=1 eles são iniciados à parte (`python worker_massa.py`), na
+# mesma máquina: a fila é o SQLite em MASSA_DB, que um dyno/contêiner separado não enxerga.
+_processos_massa = None
+
+def when_ready(server):
+    global _processos_massa
+    if workers > 1:
+        server.log.warning(f"WEB_CONCURRENCY={workers}: cotações selecionadas e solicitações de coleta ficam "
+                           "em memória por worker; cada requisição vê só os dados do worker que a atendeu")
+    if os.environ.get("MASSA_WORKERS_EXTERNOS") != "1":
+        # Sem importar worker_massa aqui: o master não deve criar locks/threads antes do fork
+        # (os workers gevent aplicam o monkey patch depois)
+        import subprocess
+        import sys
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker_massa.py")
+        _processos_massa = subprocess.Popen([sys.executable, script])
+        server.log.info(f"Processos da cotação em massa iniciados (pid {_processos_massa.pid})")
+
+def on_exit(server):
+    if _processos_massa is not None and _processos_massa.poll() is None:
+        _processos_massa.terminate()
+        try:
+            _processos_massa.wait(timeout=15)
+        except Exception:
+            _processos_massa.kill()
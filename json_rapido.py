@@ -0,0 +1,70 @@
+"""
+Camada de JSON rápida: usa `orjson` quando instalado e cai para o `json` da stdlib.
+
+- `loads` / `dumps` para o cliente de fretes e para logs;
+- `ProvedorJSON` para o `app.json` do Flask (jsonify, request.get_json, tojson).
+"""
+import json
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    _OPCOES = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def loads(dados):
+        return orjson.loads(dados)
+
+    def dumps(obj) -> str:
+        """Serializa para str (UTF-8, sem escapes ASCII); tipos desconhecidos viram str."""
+        try:
+            return orjson.dumps(obj, default=str, option=_OPCOES).decode("utf-8")
+        except TypeError:
+            return json.dumps(obj, ensure_ascii=False, default=str)
+else:
+    _OPCOES = 0
+
+    def loads(dados):
+        return json.loads(dados)
+
+    def dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False, default=str)
+
+class ProvedorJSON(DefaultJSONProvider):
+    """JSON provider do Flask com orjson; mantém o comportamento padrão como fallback."""
+
+    def _opcoes(self, indentar=False):
+        opcoes = _OPCOES
+        if self.sort_keys:
+            opcoes |= orjson.OPT_SORT_KEYS
+        if indentar:
+            opcoes |= orjson.OPT_INDENT_2
+        return opcoes
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        try:
+            return orjson.dumps(obj, default=self.default, option=self._opcoes()).decode("utf-8")
+        except TypeError:
+            return super().dumps(obj)
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        indentar = self.compact is False or (self.compact is None and self._app.debug)
+        try:
+            dados = orjson.dumps(obj, default=self.default, option=self._opcoes(indentar))
+        except TypeError:
+            return super().response(obj)
+        return self._app.response_class(dados + b"\n", mimetype=self.mimetype)
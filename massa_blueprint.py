@@ -1,15 +1,25 @@
-from flask import Blueprint, render_template, request, jsonify, current_app, send_file
-import pandas as pd
+from flask import Blueprint, render_template, request, jsonify, current_app, send_file, session
 import requests
+import cliente_frete
+import despacho
+import compressao
+import fila_jobs
+import json_rapido
+import perfil
+import tokens_frete
+from estatisticas_massa import EstatisticasMassa
+from registros_massa import OpcaoFrete, CotacaoLinha, linhas_resultado
 import re
 import time
+import codecs
+import csv
 import os
 from io import BytesIO
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 import threading
-import atexit
+from concurrent.futures import ThreadPoolExecutor
 import logging
-import json
 import uuid
 from datetime import datetime
 
@@ -19,22 +29,157 @@ log = logging.getLogger(__name__)
 
 # Configurações para cotação em massa
 ALLOWED_EXTENSIONS = {'xlsx'}
+STREAM_TIPOS = {"text/csv": "csv", "application/x-ndjson": "ndjson", "application/jsonl": "ndjson"}
+
+# pandas/openpyxl são importados sob demanda (dentro das funções que os usam):
+# workers que só atendem /cotar e /relatorios não pagam esse custo no boot.
+def precarregar_dependencias():
+    """Importa pandas/openpyxl antecipadamente (no master do gunicorn, com MASSA_PRECARREGAR=1)."""
+    import pandas  # noqa: F401
+    import openpyxl  # noqa: F401
+
+# ------------------------------------------------------------
+# Controle adaptativo de concorrência (AIMD)
+# ------------------------------------------------------------
+class ControleConcorrencia:
+    """
+    Limita quantas cotações da massa ficam em voo ao mesmo tempo.
+    - Aumento aditivo: cada resposta saudável soma 1/limite (≈ +1 por rodada).
+    - Redução multiplicativa: 429/503, timeout ou pico de latência cortam o limite
+      pela metade (no máximo uma vez por latência-base, para não punir a mesma rajada).
+    """
+    def __init__(self, inicial=2, minimo=1, maximo=16, fator_reducao=0.5, fator_pico=2.0, alfa=0.2):
+        self.minimo = max(1, int(minimo))
+        self.maximo = max(self.minimo, int(maximo))
+        self.limite = float(min(max(int(inicial), self.minimo), self.maximo))
+        self.fator_reducao = fator_reducao
+        self.fator_pico = fator_pico
+        self.alfa = alfa
+        self.em_andamento = 0
+        self.latencia_base = None   # EWMA das latências (s)
+        self.taxa_erro = 0.0        # EWMA de respostas com erro (0..1)
+        self.ultima_reducao = 0.0
+        self._cond = threading.Condition()
+
+    def adquirir(self, timeout=None):
+        """Reserva uma vaga; devolve False se o timeout expirar."""
+        with self._cond:
+            ok = self._cond.wait_for(lambda: self.em_andamento < int(self.limite), timeout)
+            if ok:
+                self.em_andamento += 1
+            return ok
+
+    def liberar(self):
+        with self._cond:
+            self.em_andamento = max(0, self.em_andamento - 1)
+            self._cond.notify_all()
+
+    def registrar(self, latencia, sobrecarga=False, erro=False):
+        """Ajusta o limite a partir do resultado de uma chamada ao upstream."""
+        with self._cond:
+            agora = time.monotonic()
+            base = self.latencia_base
+            pico = base is not None and latencia > base * self.fator_pico
+            self.taxa_erro += self.alfa * ((1.0 if (erro or sobrecarga) else 0.0) - self.taxa_erro)
+            if not sobrecarga:
+                self.latencia_base = latencia if base is None else base + self.alfa * (latencia - base)
+
+            if sobrecarga or pico:
+                if agora - self.ultima_reducao >= (base or latencia):
+                    self.limite = max(float(self.minimo), self.limite * self.fator_reducao)
+                    self.ultima_reducao = agora
+                    log.info(f"AIMD: reduzindo limite para {int(self.limite)} "
+                             f"(sobrecarga={sobrecarga}, latencia={latencia:.2f}s)")
+            elif not erro and self.taxa_erro < 0.1:
+                self.limite = min(float(self.maximo), self.limite + 1.0 / self.limite)
+            self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                "limite_concorrencia": int(self.limite),
+                "em_andamento": self.em_andamento,
+                "latencia_media_ms": int(self.latencia_base * 1000) if self.latencia_base is not None else None,
+            }
+
+class RitmoJob:
+    """
+    Ritmo de um job: EWMA de linhas/s (uma amostra por publicação do progresso, no
+    mínimo 1 s entre amostras), linhas com erro e tempo sem avanço, para ETA e
+    diagnóstico de job parado. A latência do upstream vem do ControleConcorrencia.
+    """
+    def __init__(self, alfa=0.3, intervalo=1.0):
+        self.alfa = alfa
+        self.intervalo = intervalo
+        self.inicio = time.monotonic()
+        self.concluidas = 0
+        self.erros = 0
+        self.sem_resultado = 0
+        self.linhas_s = None         # EWMA (linhas/s)
+        self.ultima_linha = None
+        self.fase = "lendo"          # lendo | cotando | gravando
+        self._amostra = (self.inicio, 0)
+        self._lock = threading.Lock()
+
+    def registrar(self, status):
+        with self._lock:
+            self.concluidas += 1
+            if status == "erro":
+                self.erros += 1
+            elif status == "sem_resultado":
+                self.sem_resultado += 1
+            self.ultima_linha = time.monotonic()
+
+    def snapshot(self, restantes, final=False):
+        agora = time.monotonic()
+        with self._lock:
+            t0, n0 = self._amostra
+            # Sem linhas restantes (gravando o XLSX) a taxa fica congelada no último valor
+            if agora - t0 >= self.intervalo and (restantes > 0 or self.concluidas > n0):
+                taxa = (self.concluidas - n0) / (agora - t0)
+                self.linhas_s = taxa if self.linhas_s is None else self.linhas_s + self.alfa * (taxa - self.linhas_s)
+                self._amostra = (agora, self.concluidas)
+            decorrido = agora - self.inicio
+            eta = restantes / self.linhas_s if not final and restantes > 0 and self.linhas_s else None
+            return {
+                "fase": self.fase,
+                "decorrido_s": round(decorrido, 1),
+                "linhas_por_s": round(self.linhas_s, 2) if self.linhas_s is not None else None,
+                "linhas_por_s_media": round(self.concluidas / decorrido, 2) if decorrido > 0 else None,
+                "eta_s": round(eta) if eta is not None else (0 if final and restantes == 0 else None),
+                "linhas_erro": self.erros,
+                "linhas_sem_resultado": self.sem_resultado,
+                "sem_avanco_s": round(agora - (self.ultima_linha or self.inicio), 1),
+            }
+
+def _novo_controle(config):
+    return ControleConcorrencia(
+        inicial=config.get("MASSA_CONCORRENCIA_INICIAL", 2),
+        minimo=config.get("MASSA_CONCORRENCIA_MIN", 1),
+        maximo=config.get("MASSA_CONCORRENCIA_MAX", 16),
+        fator_pico=config.get("MASSA_LATENCIA_PICO_FATOR", 2.0),
+    )
 
-# Variável global para progresso da cotação em massa
 class ProgressState:
-    def __init__(self):
+    """Estado de um job em execução no processo de cotação (ver worker_massa.py)."""
+    def __init__(self, job_id=None, tipo_retorno='todas_opcoes', controle=None):
+        self.job_id = job_id
+        self.dono = None  # quem reveza com os outros jobs no despachante (padrão: o próprio job)
         self.total = 0
         self.atual = 0
-        self.processando = False
-        self.arquivo = None
         self.erro = None
-        self.nome_arquivo = None
+        self.recebendo = False  # upload em streaming ainda chegando
         self.cancelar = False
-        self.thread = None
-        self.controle_requisicoes = [0, time.time()]
-        self.tipo_retorno = 'todas_opcoes'  # padrão (lista todas as opções)
-
-progresso = ProgressState()
+        self.controle = controle or ControleConcorrencia()
+        self.lock = threading.Lock()
+        self.estatisticas = EstatisticasMassa()
+        self.etapas = perfil.Etapas()  # tempo por etapa (payload, upstream, normalizar, pandas, xlsx)
+        self.ritmo = RitmoJob()        # linhas/s, ETA, erros
+        self.perfilador = None         # perfil.Perfilador quando o job foi pedido com perfilamento
+        self.tipo_retorno = tipo_retorno  # padrão: lista todas as opções
+        self.enviadas = []             # (linha, future) já entregues ao executor, na ordem da planilha
+        self.restantes = None          # restantes(n) -> linhas depois das n primeiras (ainda não enviadas)
+        self.parcial_pedido = None     # último pedido de XLSX parcial lido da fila
 
 # ------------------------------------------------------------
 # Funções auxiliares
@@ -43,8 +188,14 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 def _num(s, default="0"):
+    """Número de planilha/CSV: aceita "2,5", "2.5", "1.234,56" e "1,234.56"."""
     try:
-        return float(str(s if s is not None else default).replace(",", "."))
+        texto = str(s if s is not None else default).strip()
+        if "," in texto and "." in texto:
+            # O separador que vem por último é o decimal; o outro é de milhar
+            milhar = "." if texto.rfind(",") > texto.rfind(".") else ","
+            texto = texto.replace(milhar, "")
+        return float(texto.replace(",", "."))
     except Exception:
         return float(default)
 
@@ -58,49 +209,35 @@ def _limpar_cnpj(cnpj):
     return re.sub(r"\D", "", str(cnpj or ""))
 
 def _normalizar_opcao(o):
-    """Garante todas as chaves com valores padrão e total numérico."""
+    """Converte uma opção da API em `OpcaoFrete` (valores padrão e total numérico)."""
     if not isinstance(o, dict):
         log.error(f"Dado inválido para normalização (não é dicionário): {o}")
-        return {
-            "transportadora": "N/D",
-            "integrador": "",
-            "total": 0.0,
-            "prazo": "N/A",
-            "servico": "Padrão",
-            "imagem": "",
-            "observacao": "Dado inválido: não é dicionário"
-        }
+        return OpcaoFrete(observacao="Dado inválido: não é dicionário")
     try:
         servico = o.get("servico", "Padrão")
         if servico is None or not isinstance(servico, (str, int, float)):
             servico = "Padrão"
         else:
             servico = str(servico).strip() or "Padrão"
-        return {
-            "transportadora": str(o.get("transportadora", "N/D") or "N/D"),
-            "integrador": str(o.get("integrador", "") or ""),
-            "total": _num(o.get("total", 0)),
-            "prazo": str(o.get("prazo", "N/A") or "N/A"),
-            "servico": servico,
-            "imagem": str(o.get("imagem", "") or ""),
-            "observacao": str(o.get("observacao", "") or "")
-        }
+        return OpcaoFrete(
+            transportadora=str(o.get("transportadora", "N/D") or "N/D"),
+            integrador=str(o.get("integrador", "") or ""),
+            total=_num(o.get("total", 0)),
+            prazo=str(o.get("prazo", "N/A") or "N/A"),
+            servico=servico,
+            imagem=str(o.get("imagem", "") or ""),
+            observacao=str(o.get("observacao", "") or "")
+        )
     except Exception as e:
         log.error(f"Erro ao normalizar opção: {o}, erro: {str(e)}")
-        return {
-            "transportadora": "N/D",
-            "integrador": "",
-            "total": 0.0,
-            "prazo": "N/A",
-            "servico": "Padrão",
-            "imagem": "",
-            "observacao": f"Erro na normalização: {str(e)}"
-        }
+        return OpcaoFrete(observacao=f"Erro na normalização: {str(e)}")
 
 def processar_cotacao_massa(row, url_api, token, progresso):
     if not url_api or not token:
         raise ValueError("URL_API ou TOKEN_API não configurados")
 
+    etapas = progresso.etapas
+    inicio_payload = time.perf_counter()
     payload = {
         "id_contrato_transportadora_segmento": str(row.get("id_contrato_transportadora_segmento", "")),
         "cnpj_origem": _limpar_cnpj(row.get("cnpj_origem")),
@@ -122,167 +259,268 @@ def processar_cotacao_massa(row, url_api, token, progresso):
         }]
     }
     headers = {"Authorization": token, "Content-Type": "application/json"}
+    etapas.registrar("payload", time.perf_counter() - inicio_payload)
 
+    controle = progresso.controle
+    inicio = time.monotonic()
     try:
-        # Rate limit simples
-        if progresso.controle_requisicoes[0] >= 15:
-            tempo_passado = time.time() - progresso.controle_requisicoes[1]
-            if tempo_passado < 10:
-                time.sleep(10 - tempo_passado)
-            progresso.controle_requisicoes[0] = 0
-            progresso.controle_requisicoes[1] = time.time()
-
-        log.debug(f"Enviando requisição para {url_api} com payload: {json.dumps(payload, ensure_ascii=False)}")
-        resp = requests.post(url_api, headers=headers, json=payload, timeout=30)
-        progresso.controle_requisicoes[0] += 1
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f"Enviando requisição para {url_api} com payload: {json_rapido.dumps(payload)}")
+        resp = cliente_frete.post(url_api, headers=headers, json=payload, timeout=30, classe=despacho.MASSA,
+                                  dono=progresso.dono or progresso.job_id, etapas=etapas)
+        # Só o tempo no upstream: a espera na fila do despachante não é sinal de sobrecarga
+        latencia = resp.elapsed.total_seconds()
+        if resp.status_code in (429, 503):
+            controle.registrar(latencia, sobrecarga=True)
+        else:
+            controle.registrar(latencia, erro=resp.status_code >= 400)
         resp.raise_for_status()
-        data = resp.json()
-        log.debug(f"Resposta da API (linha {progresso.atual}): {json.dumps(data, ensure_ascii=False)}")
+        with etapas.medir("json"):
+            data = cliente_frete.ler_json(resp)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f"Resposta da API (linha {progresso.atual}): {json_rapido.dumps(data)}")
 
         if not isinstance(data, dict) or data.get("erro"):
-            return {
-                "status": "sem_resultado",
-                "mensagem": data.get("mensagem", "Nenhuma cotação disponível") if isinstance(data, dict) else "Resposta inválida"
-            }
+            return CotacaoLinha(
+                "sem_resultado",
+                data.get("mensagem", "Nenhuma cotação disponível") if isinstance(data, dict) else "Resposta inválida"
+            )
 
         brutas = data.get("resultado") or []
-        opcoes = [_normalizar_opcao(o) for o in brutas if isinstance(o, dict)]
-        opcoes_validas = [o for o in opcoes if isinstance(o.get("total"), (int, float)) and o.get("total") >= 0]
+        with etapas.medir("normalizar"):
+            opcoes = [_normalizar_opcao(o) for o in brutas if isinstance(o, dict)]
+        opcoes_validas = [o for o in opcoes if isinstance(o.total, (int, float)) and o.total >= 0]
 
         if not opcoes_validas:
-            return {"status": "sem_resultado", "mensagem": "Nenhuma cotação com total válido"}
-
-        mais_barata = min(opcoes_validas, key=lambda x: x.get("total", 0))
-        return {"status": "sucesso", "mais_barata": mais_barata, "todas_opcoes": opcoes}
-
+            return CotacaoLinha("sem_resultado", "Nenhuma cotação com total válido")
+
+        mais_barata = min(opcoes_validas, key=lambda x: x.total)
+        return CotacaoLinha("sucesso", opcoes=opcoes, mais_barata=mais_barata)
+
+    except despacho.SemVagaDisponivel as e:
+        # Espera na fila do despachante (prioridade do interativo), não sobrecarga do upstream:
+        # vem antes do Timeout (é uma subclasse) e não passa pelo AIMD
+        log.warning(f"Linha sem vaga no despachante: {str(e)}")
+        return CotacaoLinha("erro", str(e))
+    except tokens_frete.SemTokenDisponivel as e:
+        # Todos os tokens esfriando ou sem saldo: a espera foi pelo orçamento, não pelo upstream,
+        # e não pode entrar na latência base do AIMD
+        log.warning(f"Linha sem token da API disponível: {str(e)}")
+        return CotacaoLinha("erro", str(e))
+    except requests.exceptions.Timeout as e:
+        controle.registrar(time.monotonic() - inicio, sobrecarga=True)
+        log.error(f"Timeout na requisição HTTP: {str(e)}")
+        return CotacaoLinha("erro", str(e))
+    except requests.exceptions.HTTPError as e:
+        log.error(f"Erro na requisição HTTP: {str(e)}")
+        return CotacaoLinha("erro", str(e))
     except requests.exceptions.RequestException as e:
+        controle.registrar(time.monotonic() - inicio, erro=True)
         log.error(f"Erro na requisição HTTP: {str(e)}")
-        return {"status": "erro", "mensagem": str(e)}
+        return CotacaoLinha("erro", str(e))
     except ValueError as e:
         log.error(f"Erro ao parsear resposta JSON: {str(e)}")
-        return {"status": "erro", "mensagem": "Resposta não-JSON da API"}
-
-def processar_arquivo_background(filepath, app, logger):
-    with app.app_context():
+        return CotacaoLinha("erro", "Resposta não-JSON da API")
+
+def _executar_linhas(linhas, url_api, token, estado, logger):
+    """
+    Cota as linhas (dicts, na ordem de chegada) com concorrência controlada pelo AIMD.
+    Devolve pares (linha, CotacaoLinha) na mesma ordem; a planilha é montada só na gravação.
+    Se o job for cancelado, as linhas que ficaram sem cotação saem como 'pendente'.
+    """
+    controle = estado.controle
+    estatisticas = estado.estatisticas
+    enviadas = estado.enviadas  # lido também pela gravação do XLSX parcial
+    estado.ritmo.fase = "cotando"
+
+    def _cotar(row):
+        status = "erro"
         try:
-            # Config
-            url_api = app.config.get("URL_API")
-            token = app.config.get("TOKEN_API")
-            if not url_api or not token:
-                raise RuntimeError("URL_API ou TOKEN_API não configurados")
-
-            # Planilha
-            try:
-                df = pd.read_excel(filepath, engine="openpyxl")
-            except ImportError:
-                progresso.erro = "Dependência 'openpyxl' não instalada. Adicione 'openpyxl' ao requirements.txt."
-                logger.error(progresso.erro)
-                return
-            except Exception as e:
-                progresso.erro = f"Falha ao ler o Excel: {str(e)}"
-                logger.exception(progresso.erro)
-                return
-
-            resultados = []
-
-            progresso.total = len(df)
-            progresso.atual = 0
-            progresso.processando = True
-            progresso.erro = None
-
-            # Loop principal (blindado)
-            for _, row in df.iterrows():
-                if progresso.cancelar:
-                    break
-
-                try:
-                    cotacao = processar_cotacao_massa(row, url_api=url_api, token=token, progresso=progresso)
-                    logger.debug(f"Cotação (linha {progresso.atual}): {cotacao}")
-                except Exception:
-                    logger.exception(f"Erro ao processar cotação (linha {progresso.atual})")
-                    resultados.append({
-                        **row.to_dict(),
-                        "status": "erro",
-                        "mensagem": "Erro na cotação (ver logs)"
-                    })
-                    progresso.atual += 1
-                    continue
-
-                status = (cotacao or {}).get("status")
-                if status == "sucesso":
-                    if progresso.tipo_retorno == 'mais_barata':
-                        mb = _normalizar_opcao((cotacao or {}).get("mais_barata") or {})
-                        resultados.append({
-                            **row.to_dict(),
-                            "transportadora_mais_barata": mb.get("transportadora", "N/D"),
-                            "integrador_mais_barato": mb.get("integrador", ""),
-                            "valor_frete_mais_barato": mb.get("total", 0),
-                            "prazo_mais_barato": mb.get("prazo", "N/A"),
-                            "servico_mais_barato": mb.get("servico", "Padrão"),
-                            "imagem_mais_barata": mb.get("imagem", ""),
-                            "observacao_mais_barata": mb.get("observacao", "")
-                        })
-                    else:
-                        todas = (cotacao or {}).get("todas_opcoes") or []
-                        mb = _normalizar_opcao((cotacao or {}).get("mais_barata") or {})
-                        total_mb = mb.get("total", None)
-                        if not isinstance(todas, list):
-                            logger.error(f"'todas_opcoes' não é lista (linha {progresso.atual}): {todas}")
-                            resultados.append({
-                                **row.to_dict(),
-                                "status": "erro",
-                                "mensagem": "Formato inválido de todas_opcoes"
-                            })
-                        else:
-                            for opcao in todas:
-                                opcao = _normalizar_opcao(opcao)
-                                resultados.append({
-                                    **row.to_dict(),
-                                    "transportadora": opcao.get("transportadora", "N/D"),
-                                    "integrador": opcao.get("integrador", ""),
-                                    "valor_frete": opcao.get("total", 0),
-                                    "prazo": opcao.get("prazo", "N/A"),
-                                    "servico": opcao.get("servico", "Padrão"),
-                                    "imagem": opcao.get("imagem", ""),
-                                    "observacao": opcao.get("observacao", ""),
-                                    "melhor_opcao": "Sim" if (total_mb is not None and opcao.get("total") == total_mb) else "Não"
-                                })
-                else:
-                    resultados.append({
-                        **row.to_dict(),
-                        "status": (cotacao or {}).get("status", "erro"),
-                        "mensagem": (cotacao or {}).get("mensagem", "Erro na cotação")
-                    })
-
-                progresso.atual += 1
-
-            # Saída
-            if not progresso.cancelar:
-                df_resultado = pd.DataFrame(resultados)
-                output = BytesIO()
-                try:
-                    # Escreve XLSX com openpyxl
-                    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-                        df_resultado.to_excel(writer, index=False)
-                except ImportError:
-                    progresso.erro = "Dependência 'openpyxl' não instalada para gerar o XLSX. Adicione ao requirements.txt."
-                    logger.error(progresso.erro)
-                    return
-                output.seek(0)
-                progresso.arquivo = output
-                progresso.nome_arquivo = f"resultado_{secure_filename(os.path.basename(filepath))}"
-
-        except Exception:
-            progresso.erro = "Erro geral no processamento"
-            logger.exception("Erro geral no processamento")
+            with perfil.ativo(estado.perfilador):
+                cotacao = processar_cotacao_massa(row, url_api=url_api, token=token, progresso=estado)
+            estatisticas.registrar(row, cotacao.opcoes if cotacao.sucesso else ())
+            status = cotacao.status
+            return cotacao
         finally:
-            progresso.processando = False
-
-    # Fora do app_context: I/O
+            controle.liberar()
+            with estado.lock:
+                estado.atual += 1
+            estado.ritmo.registrar(status)
+
+    # Loop principal: o controle AIMD decide quantas linhas ficam em voo
+    with ThreadPoolExecutor(max_workers=controle.maximo, thread_name_prefix="massa") as executor:
+        for row in linhas:
+            while not estado.cancelar and not controle.adquirir(timeout=0.5):
+                pass
+            if estado.cancelar:
+                break
+            enviadas.append((row, executor.submit(_cotar, row)))
+        if estado.cancelar:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    estado.ritmo.fase = "gravando"
+    return _resultados_ate_agora(estado, logger, "Não cotada (processamento cancelado)")
+
+def _resultados_ate_agora(estado, logger, motivo_pendente, parcial=False):
+    """
+    Pares (linha, CotacaoLinha) de todas as linhas conhecidas do job, na ordem da planilha:
+    as já cotadas com o resultado, as demais (em voo, descartadas ou ainda não enviadas)
+    com status 'pendente'. Com parcial=True não espera as cotações em voo.
+    """
+    pendente = CotacaoLinha("pendente", motivo_pendente)
+    enviadas = list(estado.enviadas)  # retrato: o loop principal continua anexando
+    resultados = []
+    for idx, (row_dict, futuro) in enumerate(enviadas):
+        if futuro.cancelled() or (parcial and not futuro.done()):
+            resultados.append((row_dict, pendente))
+            continue
+        try:
+            cotacao = futuro.result()
+            logger.debug(f"Cotação (linha {idx}): {cotacao}")
+        except Exception:
+            logger.exception(f"Erro ao processar cotação (linha {idx})")
+            cotacao = CotacaoLinha("erro", "Erro na cotação (ver logs)")
+        resultados.append((row_dict, cotacao))
+    if estado.restantes is not None:
+        resultados.extend((row_dict, pendente) for row_dict in estado.restantes(len(enviadas)))
+    return resultados
+
+def _celula(valor):
+    """Vazios do pandas (NaN/NaT) viram célula vazia, como no to_excel."""
+    return None if valor != valor else valor
+
+def _escrever_aba(wb, titulo, linhas, colunas=None):
+    """Aba em modo write_only; sem `colunas`, usa a união das chaves na ordem em que aparecem."""
+    ws = wb.create_sheet(titulo)
+    if colunas is None:
+        colunas = list(dict.fromkeys(k for linha in linhas for k in linha))
+    ws.append(colunas)
+    for linha in linhas:
+        ws.append([_celula(linha.get(c)) for c in colunas])
+
+def _gravar_resultado(resultados, caminho, estado, logger, etapa="xlsx"):
+    """
+    Grava o XLSX (resultado + resumos) em `caminho` e devolve a ETag (None se falhar).
+    As linhas da planilha são geradas a partir dos registros e escritas direto
+    (openpyxl write_only), sem montar a tabela inteira em memória.
+    """
     try:
-        os.remove(filepath)
-    except Exception:
-        pass
+        from openpyxl import Workbook
+    except ImportError:
+        estado.erro = "Dependência 'openpyxl' não instalada para gerar o XLSX. Adicione ao requirements.txt."
+        logger.error(estado.erro)
+        return None
+
+    tipo_retorno = estado.tipo_retorno
+    estatisticas = estado.estatisticas
+    # Colunas na mesma ordem do DataFrame de antes: união das chaves na ordem de aparição
+    # (todas as linhas geradas de uma mesma entrada têm as mesmas chaves)
+    colunas = {}
+    for row, cotacao in resultados:
+        for k in next(linhas_resultado(row, cotacao, tipo_retorno), ()):
+            colunas[k] = None
+    colunas = list(colunas)
+
+    inicio = time.perf_counter()
+    wb = Workbook(write_only=True)
+    _escrever_aba(wb, "Sheet1", (
+        linha for row, cotacao in resultados for linha in linhas_resultado(row, cotacao, tipo_retorno)
+    ), colunas)
+    # Resumos já agregados durante a cotação (não relê os resultados)
+    _escrever_aba(wb, "Resumo_transportadoras", estatisticas.resumo_transportadoras())
+    _escrever_aba(wb, "Resumo_UF", [
+        {k: v for k, v in linha.items() if k != "vitorias_por_transportadora"}
+        for linha in estatisticas.resumo_ufs()
+    ])
+
+    os.makedirs(os.path.dirname(caminho) or ".", exist_ok=True)
+    temporario = f"{caminho}.tmp"
+    wb.save(temporario)
+    with open(temporario, "rb") as f:
+        etag = compressao.etag_de(f.read())
+    os.replace(temporario, caminho)  # quem baixa nunca vê um arquivo pela metade
+    estado.etapas.registrar(etapa, time.perf_counter() - inicio)
+    return etag
+
+def ler_planilha(filepath, estado, logger):
+    """Linhas (dicts) do XLSX enviado; None se não der para ler (erro em `estado.erro`)."""
+    try:
+        import pandas as pd
+        with estado.etapas.medir("pandas_leitura"):
+            df = pd.read_excel(filepath, engine="openpyxl")
+            linhas = df.to_dict("records")
+    except ImportError:
+        estado.erro = "Dependência 'pandas'/'openpyxl' não instalada. Adicione ambas ao requirements.txt."
+        logger.error(estado.erro)
+        return None
+    except Exception as e:
+        estado.erro = f"Falha ao ler o Excel: {str(e)}"
+        logger.exception(estado.erro)
+        return None
+    return linhas
+
+# ------------------------------------------------------------
+# Upload em streaming (CSV / NDJSON)
+# ------------------------------------------------------------
+# Colunas numéricas do lote: no streaming chegam como texto ("2,5", "1.234,56") e são
+# convertidas como o pandas faz no XLSX, para o upstream receber o mesmo payload
+STREAM_CAMPOS_DECIMAIS = ("peso", "altura", "largura", "profundidade", "valor")
+STREAM_CAMPOS_INTEIROS = ("quantidade",)
+
+def _ler_linhas(stream, charset=None, tamanho_max=1024 * 1024):
+    """
+    Devolve as linhas do corpo da requisição (str, com '\\n') assim que cada uma chega.
+    Usa o charset do Content-Type; sem ele tenta UTF-8 e, na primeira linha que não
+    decodifica, passa para cp1252 (padrão do Excel pt-BR ao salvar CSV).
+    """
+    codificacao = charset or "utf-8"
+    primeira = True
+    while True:
+        linha = stream.readline(tamanho_max)
+        if not linha:
+            break
+        if primeira and codificacao == "utf-8" and linha.startswith(b"\xef\xbb\xbf"):
+            linha = linha[3:]  # BOM do UTF-8
+        primeira = False
+        try:
+            texto = linha.decode(codificacao)
+        except UnicodeDecodeError:
+            if charset or codificacao != "utf-8":
+                raise
+            codificacao = "cp1252"
+            texto = linha.decode(codificacao)
+        yield texto
+
+def _normalizar_linha_stream(linha):
+    """Números em texto viram float/int; vazios e valores já numéricos ficam como estão."""
+    for campo in STREAM_CAMPOS_DECIMAIS + STREAM_CAMPOS_INTEIROS:
+        valor = linha.get(campo)
+        if isinstance(valor, str) and valor.strip():
+            numero = _num(valor, default="nan")
+            if numero != numero:  # nan: não é número
+                raise ValueError(f"'{campo}' não é um número: {valor!r}")
+            linha[campo] = int(numero) if campo in STREAM_CAMPOS_INTEIROS and numero.is_integer() else numero
+    return linha
+
+def _linhas_csv(stream, charset=None):
+    """CSV com cabeçalho; separador ';' ou ',' detectado pela primeira linha."""
+    linhas = _ler_linhas(stream, charset)
+    cabecalho = next(linhas, "")
+    separador = ";" if cabecalho.count(";") > cabecalho.count(",") else ","
+    campos = [c.strip() for c in next(csv.reader([cabecalho], delimiter=separador), [])]
+    for linha in csv.DictReader(linhas, fieldnames=campos, delimiter=separador):
+        yield _normalizar_linha_stream({k: v for k, v in linha.items() if k is not None})
+
+def _linhas_ndjson(stream, charset=None):
+    for linha in _ler_linhas(stream, charset):
+        if linha.strip():
+            item = json_rapido.loads(linha)
+            if not isinstance(item, dict):
+                raise ValueError("Cada linha NDJSON deve ser um objeto")
+            yield _normalizar_linha_stream(item)
+
+_modelo_cache = None  # (bytes, etag): o modelo é fixo, gerado uma vez por processo
+_modelo_lock = threading.Lock()
 
 def gerar_modelo():
     dados_modelo = [{
@@ -304,6 +542,7 @@ def gerar_modelo():
         "valor": 500,
         "observacao": "Embalagem frágil"
     }]
+    import pandas as pd
     df = pd.DataFrame(dados_modelo)
     output = BytesIO()
     with pd.ExcelWriter(output, engine="openpyxl") as writer:
@@ -311,11 +550,21 @@ def gerar_modelo():
     output.seek(0)
     return output
 
+def obter_modelo():
+    """Bytes e ETag do modelo XLSX (gerado na primeira chamada)."""
+    global _modelo_cache
+    with _modelo_lock:
+        if _modelo_cache is None:
+            dados = gerar_modelo().getvalue()
+            _modelo_cache = (dados, compressao.etag_de(dados))
+        return _modelo_cache
+
 # ------------------------------------------------------------
 # Rotas do Blueprint
 # ------------------------------------------------------------
 @massa_bp.get("/", endpoint="massa_home")
 def massa_home():
+    _dono()  # cookie já existe quando o upload em streaming começa (o progresso é consultado antes da resposta)
     return render_template("massa.html", title="Cotação em Massa")
 
 @massa_bp.post("/cotar-em-massa", endpoint="cotar_em_massa")
@@ -332,6 +581,7 @@ def cotar_em_massa():
             return jsonify({"status": "erro", "mensagem": "TOKEN_API/URL_API não configurados."}), 500
 
         headers = {"Authorization": token, "Content-Type": "application/json"}
+        dono = _dono()
         resultados = []
 
         for idx, it in enumerate(itens):
@@ -373,11 +623,14 @@ def cotar_em_massa():
             }
 
             try:
-                log.debug(f"Enviando requisição para {url_api} com payload: {json.dumps(payload, ensure_ascii=False)}")
-                r = requests.post(url_api, headers=headers, json=payload, timeout=30)
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug(f"Enviando requisição para {url_api} com payload: {json_rapido.dumps(payload)}")
+                r = cliente_frete.post(url_api, headers=headers, json=payload, timeout=30,
+                                       classe=despacho.MASSA, dono=dono)
                 r.raise_for_status()
-                data = r.json()
-                log.debug(f"Resposta da API para {ref}: {json.dumps(data, ensure_ascii=False)}")
+                data = cliente_frete.ler_json(r)
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug(f"Resposta da API para {ref}: {json_rapido.dumps(data)}")
             except requests.exceptions.RequestException as e:
                 resultados.append({"ref": ref, "ok": False, "erro": f"Falha HTTP: {e}"})
                 continue
@@ -385,9 +638,7 @@ def cotar_em_massa():
                 resultados.append({"ref": ref, "ok": False, "erro": "Resposta não-JSON da API externa"})
                 continue
 
-            opcoes = []
-            for o in (data.get("resultado") or []):
-                opcoes.append(_normalizar_opcao(o))
+            opcoes = [_normalizar_opcao(o).para_dict() for o in (data.get("resultado") or [])]
 
             resultados.append({"ref": ref, "ok": True, "opcoes": opcoes, "mensagem": data.get("mensagem")})
 
@@ -402,14 +653,36 @@ def solicitar_coleta():
 
 @massa_bp.get("/baixar_modelo", endpoint="baixar_modelo")
 def baixar_modelo():
-    modelo = gerar_modelo()
+    dados, etag = obter_modelo()
     return send_file(
-        modelo,
+        BytesIO(dados),
         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         download_name="modelo_cotacao_massa.xlsx",
-        as_attachment=True
+        as_attachment=True,
+        etag=etag
     )
 
+def _dono():
+    """Identifica o navegador (cookie de sessão) para associar os jobs a quem os criou."""
+    if "massa_dono" not in session:
+        session["massa_dono"] = uuid.uuid4().hex
+    return session["massa_dono"]
+
+def _criar_job(origem, tipo_retorno, **campos):
+    """Cancela o job anterior do mesmo usuário e enfileira o novo (quem executa é o worker_massa)."""
+    dono = _dono()
+    for job_id in fila_jobs.jobs_ativos(dono):
+        fila_jobs.pedir_cancelamento(job_id)
+    return fila_jobs.criar_job(origem, tipo_retorno, dono=dono, perfil=perfil.pedido(current_app), **campos)
+
+def _job_da_requisicao():
+    """Job de ?job=<id>; senão o último criado por este usuário."""
+    job_id = request.args.get("job")
+    if job_id:
+        return fila_jobs.obter_job(job_id)
+    dono = session.get("massa_dono")
+    return fila_jobs.ultimo_job(dono) if dono else None
+
 @massa_bp.route("/upload", methods=["POST"], endpoint="upload")
 def upload():
     if 'arquivo' not in request.files:
@@ -422,95 +695,210 @@ def upload():
     if not allowed_file(file.filename):
         return jsonify({"erro": "Tipo de arquivo não permitido"}), 400
 
-    progresso.tipo_retorno = request.form.get('tipo_retorno', 'todas_opcoes')
-
     filename = secure_filename(file.filename)
     upload_dir = current_app.config['UPLOAD_FOLDER']
     os.makedirs(upload_dir, exist_ok=True)
-    filepath = os.path.join(upload_dir, filename)
+    # Nome único: dois uploads com o mesmo nome não se sobrescrevem na fila
+    filepath = os.path.join(upload_dir, f"{uuid.uuid4().hex}_{filename}")
     file.save(filepath)
 
-    # Reset
-    progresso.total = progresso.atual = 0
-    progresso.processando = True
-    progresso.arquivo = None
-    progresso.erro = None
-    progresso.nome_arquivo = None
-    progresso.cancelar = False
-    progresso.controle_requisicoes = [0, time.time()]
-
-    app = current_app._get_current_object()
-    logger = current_app.logger
-
-    if progresso.thread is not None and progresso.thread.is_alive():
-        progresso.cancelar = True
-        progresso.thread.join()
-
-    progresso.thread = threading.Thread(
-        target=processar_arquivo_background,
-        args=(filepath, app, logger),
-        daemon=True
-    )
-    progresso.thread.start()
+    job_id = _criar_job("xlsx", request.form.get('tipo_retorno', 'todas_opcoes'),
+                        arquivo_entrada=filepath, nome_resultado=f"resultado_{filename}")
+
+    return jsonify({"mensagem": "Processamento iniciado", "job": job_id})
+
+@massa_bp.post("/upload_stream", endpoint="upload_stream")
+def upload_stream():
+    """
+    Recebe o lote no corpo da requisição (text/csv ou application/x-ndjson) e enfileira as
+    linhas em lotes enquanto o upload ainda está chegando; o worker_massa já vai cotando.
+    Se a cotação atrasar mais que MASSA_STREAM_BUFFER_LINHAS, a leitura do corpo para
+    (backpressure até o cliente via TCP).
+    Parâmetros na query string: tipo_retorno, nome.
+    """
+    formato = STREAM_TIPOS.get(request.mimetype)
+    if formato is None:
+        return jsonify({"erro": "Envie o corpo como text/csv ou application/x-ndjson"}), 415
+    charset = request.mimetype_params.get("charset")
+    if charset:
+        try:
+            charset = codecs.lookup(charset).name
+        except LookupError:
+            return jsonify({"erro": f"Charset desconhecido: {charset}"}), 415
+
+    # Limite próprio para o streaming (o MAX_CONTENT_LENGTH vale para o upload de XLSX)
+    request.max_content_length = current_app.config["MASSA_STREAM_MAX_MB"] * 1024 * 1024
+    buffer = max(1, current_app.config["MASSA_STREAM_BUFFER_LINHAS"])
+    tamanho_lote = min(100, buffer)
+
+    nome = secure_filename(request.args.get("nome") or f"lote.{formato}") or f"lote.{formato}"
+    job_id = _criar_job(formato, request.args.get("tipo_retorno", "todas_opcoes"),
+                        nome_resultado=f"resultado_{os.path.splitext(nome)[0]}.xlsx", recebendo=True)
+
+    recebidas = 0
+    lote = []
+
+    def _enviar_lote():
+        """Grava o lote; devolve False se o job foi cancelado."""
+        nonlocal recebidas
+        with perfil.etapa("fila_gravacao"):
+            fila_jobs.adicionar_linhas(job_id, recebidas + 1, lote)
+        recebidas += len(lote)
+        lote.clear()
+        with perfil.etapa("backpressure"):
+            sinal = time.monotonic()
+            while True:
+                job = fila_jobs.obter_job(job_id)
+                if job["cancelar"] or job["status"] not in fila_jobs.STATUS_ATIVOS:
+                    return False
+                if recebidas - job["atual"] <= buffer:
+                    return True
+                if time.monotonic() - sinal > 5:
+                    sinal = time.monotonic()
+                    fila_jobs.sinalizar_recebimento(job_id)  # parado por nossa causa, não é órfão
+                time.sleep(0.2)
+
+    # Qualquer saída (cliente desconectado, erro de disco...) encerra o recebimento: senão o
+    # worker do job esperaria linhas para sempre
+    erro = "Upload interrompido"
+    try:
+        leitor = _linhas_csv if formato == "csv" else _linhas_ndjson
+        linhas = leitor(request.stream, charset)
+        for linha in linhas:
+            lote.append(linha)
+            if len(lote) >= tamanho_lote and not _enviar_lote():
+                break
+        else:
+            if lote:
+                _enviar_lote()
+        erro = None
+    except RequestEntityTooLarge:
+        erro = f"Upload maior que o limite de {current_app.config['MASSA_STREAM_MAX_MB']} MB"
+        return jsonify({"erro": erro, "job": job_id, "linhas_recebidas": recebidas}), 413
+    except ValueError as e:
+        erro = f"Linha {recebidas + len(lote) + 1} inválida: {str(e)}"
+        return jsonify({"erro": erro, "job": job_id, "linhas_recebidas": recebidas}), 400
+    finally:
+        fila_jobs.finalizar_recebimento(job_id, erro=erro)
 
-    return jsonify({"mensagem": "Processamento iniciado"})
+    return jsonify({"mensagem": "Upload recebido; processamento em andamento",
+                    "job": job_id, "linhas_recebidas": recebidas})
 
 @massa_bp.get("/progresso", endpoint="progresso")
 @massa_bp.get("/obter_progresso", endpoint="obter_progresso")  # alias p/ templates antigos
 def obter_progresso():
-    if progresso.thread is not None and not progresso.thread.is_alive():
-        progresso.processando = False
+    job = _job_da_requisicao()
+    if job is None:
+        return jsonify({"processando": False, "progresso": 0, "atual": 0, "total": 0,
+                        "erro": "Processamento não iniciado ou cancelado"})
 
+    processando = job["status"] in fila_jobs.STATUS_ATIVOS
     response_data = {
-        "processando": progresso.processando,
-        "progresso": int((progresso.atual / progresso.total) * 100) if progresso.total > 0 else 0,
-        "atual": progresso.atual,
-        "total": progresso.total
+        "job": job["id"],
+        "status": job["status"],
+        "processando": processando,
+        "recebendo": bool(job["recebendo"]),
+        "progresso": int((job["atual"] / job["total"]) * 100) if job["total"] > 0 else 0,
+        "atual": job["atual"],
+        "total": job["total"],
+        **job["metricas"]
     }
-    if progresso.erro:
+    if job["erro"]:
         response_data.update({
-            "erro": progresso.erro,
+            "erro": job["erro"],
             "processando": False
         })
-    elif not progresso.processando and progresso.arquivo is not None:
+    elif job["status"] == "concluido" and job["arquivo_resultado"]:
         response_data.update({
             "completo": True,
-            "nome_arquivo": progresso.nome_arquivo
+            "nome_arquivo": job["nome_resultado"]
         })
-    elif not progresso.processando:
+    elif not processando:
         response_data.update({
             "erro": "Processamento não iniciado ou cancelado",
             "processando": False
         })
+    if job["status"] == "cancelado" and job["arquivo_resultado"]:
+        response_data.update({
+            "parcial_disponivel": True,
+            "nome_arquivo": f"parcial_{job['nome_resultado'] or 'resultado_cotacoes.xlsx'}"
+        })
 
     return jsonify(response_data)
 
+@massa_bp.get("/estatisticas", endpoint="estatisticas")
+def obter_estatisticas():
+    """Agregados por transportadora e por par de UF do job (publicados pelo worker a cada ciclo)."""
+    job = _job_da_requisicao()
+    if job is None:
+        return jsonify({"processando": False, "atual": 0, "total": 0,
+                        **EstatisticasMassa().snapshot()})
+    return jsonify({
+        "job": job["id"],
+        "processando": job["status"] in fila_jobs.STATUS_ATIVOS,
+        "atual": job["atual"],
+        "total": job["total"],
+        **(job["estatisticas"] or EstatisticasMassa().snapshot())
+    })
+
+def _aguardar_parcial(job):
+    """
+    Job em andamento: pede ao worker um XLSX com o que já foi cotado e espera ficar pronto
+    (até MASSA_PARCIAL_ESPERA s). Um parcial com menos de MASSA_PARCIAL_VALIDADE s é
+    reaproveitado. Devolve o job atualizado, ou None se o arquivo não ficou pronto a tempo.
+    """
+    if job["cancelar"]:
+        pedido = float("inf")  # cancelando: o worker já vai gravar o XLSX final
+    elif job["parcial_em"] and time.time() - job["parcial_em"] < current_app.config["MASSA_PARCIAL_VALIDADE"]:
+        return job
+    else:
+        pedido = fila_jobs.pedir_parcial(job["id"])
+    limite = time.monotonic() + current_app.config["MASSA_PARCIAL_ESPERA"]
+    with perfil.etapa("parcial"):
+        while time.monotonic() < limite:
+            time.sleep(0.2)
+            job = fila_jobs.obter_job(job["id"])
+            if (job["parcial_em"] or 0) >= pedido or job["status"] not in fila_jobs.STATUS_ATIVOS:
+                return job
+    return None
+
 @massa_bp.get("/baixar_resultado", endpoint="baixar_resultado")
 def baixar_resultado():
-    if progresso.arquivo is None:
+    """
+    XLSX do job. Durante o processamento devolve um parcial (linhas ainda não cotadas com
+    status 'pendente'); job cancelado mantém o que foi cotado até o cancelamento. Job
+    ainda na fila responde 409: não existe parcial até um worker pegá-lo.
+    """
+    job = _job_da_requisicao()
+    if job is not None and job["status"] == "pendente":
+        # Nenhum worker pegou o job: não há parcial a gravar (e esperar não adianta)
+        return jsonify({"erro": "Job ainda na fila; nenhuma linha foi cotada", "job": job["id"],
+                        "status": job["status"]}), 409
+    if job is not None and job["status"] == "processando":
+        atualizado = _aguardar_parcial(job)
+        if atualizado is None:
+            resposta = jsonify({"mensagem": "Resultado parcial em preparação, tente novamente em instantes",
+                                "job": job["id"]})
+            resposta.headers["Retry-After"] = "2"
+            return resposta, 202
+        job = atualizado
+    if job is None or not job["arquivo_resultado"] or not os.path.exists(job["arquivo_resultado"]):
         return jsonify({"erro": "Nenhum arquivo disponível"}), 404
 
-    file_obj = progresso.arquivo
-    filename = progresso.nome_arquivo or "resultado_cotacoes.xlsx"
-    file_obj.seek(0)
-
+    nome = job["nome_resultado"] or "resultado_cotacoes.xlsx"
+    if job["status"] != "concluido":
+        nome = f"parcial_{nome}"
     return send_file(
-        file_obj,
+        os.path.abspath(job["arquivo_resultado"]),
         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        download_name=filename,
-        as_attachment=True
+        download_name=nome,
+        as_attachment=True,
+        etag=job["etag"] or False
     )
 
 @massa_bp.post("/cancelar", endpoint="cancelar")
 def cancelar():
-    progresso.cancelar = True
+    job = _job_da_requisicao()
+    if job is not None:
+        fila_jobs.pedir_cancelamento(job["id"])
     return jsonify({"mensagem": "Processamento cancelado"})
-
-# Cleanup ao encerrar a aplicação
-def cleanup():
-    if progresso.thread is not None and progresso.thread.is_alive():
-        progresso.cancelar = True
-        progresso.thread.join()
-
-atexit.register(cleanup)
-
@@ -0,0 +1,215 @@
+"""
+Medição de etapas e perfilamento opcional (cProfile).
+
+- Etapas: tempo acumulado por etapa (formulário, payload, espera do upstream,
+  normalização, leitura com pandas, gravação do XLSX...). Sempre ligadas (custo de
+  dois perf_counter); vão para o log e para o status dos jobs da massa. O header
+  Server-Timing só sai quando o perfilamento foi pedido (não expõe as etapas a
+  qualquer cliente).
+- cProfile: só quando pedido. PERFIL=1 perfila todas as requisições e jobs; o header
+  `X-Perfil: <PERFIL_TOKEN>` perfila uma requisição (ou o job criado por ela).
+  Os .prof vão para PERFIL_DIR (abrir com `python -m pstats` ou snakeviz).
+  Um cProfile ligado por vez em cada processo: o gancho de perfil é da thread do SO
+  (e, a partir do Python 3.12, do interpretador todo), então perfis simultâneos se
+  misturam. Pedidos que chegam com outro perfil ligado rodam sem cProfile. Nos
+  workers gevent todos os greenlets dividem a mesma thread: as requisições não são
+  perfiladas (as etapas continuam); os jobs da massa, em processos próprios, são.
+"""
+import cProfile
+import hmac
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from flask import g, has_request_context, request
+
+log = logging.getLogger(__name__)
+
+_perfil_ligado = threading.Lock()  # um Perfilador ativo por vez no processo
+
+def _sob_gevent():
+    """True no worker gevent do gunicorn (threading com monkey patch)."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("threading")
+
+class Etapas:
+    """Tempo acumulado por etapa (n, total, máximo); seguro entre threads."""
+    def __init__(self):
+        self._dados = {}  # nome -> [n, total_s, max_s]
+        self._lock = threading.Lock()
+
+    def registrar(self, nome, segundos):
+        with self._lock:
+            d = self._dados.get(nome)
+            if d is None:
+                self._dados[nome] = [1, segundos, segundos]
+            else:
+                d[0] += 1
+                d[1] += segundos
+                d[2] = max(d[2], segundos)
+
+    @contextmanager
+    def medir(self, nome):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.registrar(nome, time.perf_counter() - inicio)
+
+    def snapshot(self):
+        with self._lock:
+            return {nome: {
+                "n": n,
+                "total_ms": round(total * 1000, 1),
+                "media_ms": round(total * 1000 / n, 2),
+                "max_ms": round(maximo * 1000, 1),
+            } for nome, (n, total, maximo) in self._dados.items()}
+
+    def resumo(self):
+        """Uma linha para o log: 'upstream=1203.4ms/3 normalizar=2.1ms/150 ...'."""
+        with self._lock:
+            itens = sorted(self._dados.items(), key=lambda kv: -kv[1][1])
+            return " ".join(f"{nome}={total * 1000:.1f}ms/{n}" for nome, (n, total, _) in itens)
+
+    def server_timing(self):
+        with self._lock:
+            return ", ".join(f"{nome};dur={total * 1000:.1f}" for nome, (_, total, _) in self._dados.items())
+
+class Perfilador:
+    """
+    cProfile para trabalho espalhado em threads: um Profile por thread (o cProfile só
+    enxerga a thread que o ligou), somados em um único .prof no final.
+
+    Só um Perfilador liga o cProfile por vez no processo: o primeiro a entrar fica com
+    ele até `salvar` (outros pedidos rodam sem perfil). Onde o Python não deixa ligar
+    mais de um Profile ao mesmo tempo (3.12+), as threads além da primeira ficam de fora.
+    """
+    def __init__(self):
+        self._perfis = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._dono = None  # True: este perfilador tem o _perfil_ligado
+
+    def _reservar(self):
+        with self._lock:
+            if self._dono is None:
+                self._dono = not _sob_gevent() and _perfil_ligado.acquire(blocking=False)
+                if not self._dono:
+                    log.warning("cProfile ignorado: outro perfil em andamento neste processo ou worker gevent")
+            return self._dono
+
+    @contextmanager
+    def ativo(self):
+        if not self._reservar():
+            yield
+            return
+        perfil = getattr(self._local, "perfil", None)
+        if perfil is None:
+            perfil = self._local.perfil = cProfile.Profile()
+            with self._lock:
+                self._perfis.append(perfil)
+        try:
+            perfil.enable()
+        except ValueError:  # 3.12+: outro Profile já ligado no interpretador
+            yield
+            return
+        try:
+            yield
+        finally:
+            perfil.disable()
+
+    def salvar(self, pasta, nome):
+        """Grava o .prof, libera o cProfile para o próximo e devolve o caminho (None se nada foi medido)."""
+        with self._lock:
+            perfis = list(self._perfis)
+            if self._dono:
+                self._dono = False
+                _perfil_ligado.release()
+        if not perfis:
+            return None
+        stats = pstats.Stats(perfis[0])
+        for perfil in perfis[1:]:
+            stats.add(perfil)
+        os.makedirs(pasta, exist_ok=True)
+        caminho = os.path.join(pasta, f"{time.strftime('%Y%m%d_%H%M%S')}_{re.sub(r'[^A-Za-z0-9_.-]', '_', nome)}.prof")
+        stats.dump_stats(caminho)
+        return caminho
+
+def ativo(perfilador):
+    """Liga o perfilador na thread atual (ou não faz nada, se não houver)."""
+    return perfilador.ativo() if perfilador is not None else nullcontext()
+
+def etapa(nome):
+    """Mede uma etapa da requisição atual (fora de requisição não faz nada)."""
+    if has_request_context() and "etapas" in g:
+        return g.etapas.medir(nome)
+    return nullcontext()
+
+def registrar_etapa(nome, segundos):
+    """Como `etapa`, para trechos medidos à mão (ex.: com returns no meio)."""
+    if has_request_context() and "etapas" in g:
+        g.etapas.registrar(nome, segundos)
+
+def pedido(app):
+    """Perfilamento ligado para esta requisição? (PERFIL=1 ou header X-Perfil com o token)."""
+    if app.config.get("PERFIL_ATIVO"):
+        return True
+    token = app.config.get("PERFIL_TOKEN")
+    enviado = request.headers.get("X-Perfil") if has_request_context() else None
+    # Em bytes: compare_digest com str recusa (TypeError) texto não ASCII no header
+    return bool(token and enviado and hmac.compare_digest(enviado.encode("utf-8"), token.encode("utf-8")))
+
+def registrar(app):
+    pasta = app.config.get("PERFIL_DIR", "perfis")
+    lento = app.config.get("PERFIL_LENTO_MS", 2000) / 1000
+    if (app.config.get("PERFIL_ATIVO") or app.config.get("PERFIL_TOKEN")) and _sob_gevent():
+        log.warning("Worker gevent: requisições não são perfiladas com cProfile (só as etapas); "
+                    "jobs da massa continuam perfilados nos processos próprios")
+
+    @app.before_request
+    def _iniciar_medicao():
+        g.etapas = Etapas()
+        g.inicio_requisicao = time.perf_counter()
+        g.perfil_pedido = pedido(app)
+        if g.perfil_pedido and not _sob_gevent():
+            g.perfilador = Perfilador()
+            g.perfil_ctx = g.perfilador.ativo()
+            g.perfil_ctx.__enter__()
+
+    @app.after_request
+    def _encerrar_medicao(response):
+        if "etapas" not in g:
+            return response
+        duracao = time.perf_counter() - g.inicio_requisicao
+        perfilador = g.pop("perfilador", None)
+        if perfilador is not None:
+            g.pop("perfil_ctx").__exit__(None, None, None)
+            caminho = perfilador.salvar(pasta, f"{request.method}_{request.endpoint or 'sem_rota'}")
+            if caminho:
+                log.info(f"Perfil de {request.method} {request.path} salvo em {caminho}")
+
+        if g.perfil_pedido:
+            timing = g.etapas.server_timing()
+            response.headers["Server-Timing"] = f"{timing + ', ' if timing else ''}total;dur={duracao * 1000:.1f}"
+        nivel = logging.INFO if (g.perfil_pedido or duracao >= lento) else logging.DEBUG
+        if log.isEnabledFor(nivel):
+            log.log(nivel, f"{request.method} {request.path} {response.status_code} em {duracao * 1000:.1f}ms "
+                           f"[{g.etapas.resumo()}]")
+        return response
+
+    @app.teardown_request
+    def _desligar_perfil(_erro):
+        # Exceção não tratada pula o after_request: não deixa o cProfile ligado na thread
+        ctx = g.pop("perfil_ctx", None)
+        if ctx is not None:
+            ctx.__exit__(None, None, None)
+        perfilador = g.pop("perfilador", None)
+        if perfilador is not None:
+            perfilador.salvar(pasta, f"{request.method}_{request.endpoint or 'sem_rota'}_erro")
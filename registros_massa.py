@@ -0,0 +1,107 @@
+"""
+Registros compactos da cotação em massa.
+
+Um job `todas_opcoes` guarda dezenas de opções por linha até gerar o XLSX. Em vez de
+um dict por opção (e um dict mesclado linha+opção no resultado), usamos:
+- `OpcaoFrete`: objeto com __slots__; textos repetidos entre linhas (transportadora,
+  prazo, URL da imagem...) são internados e passam a ser compartilhados;
+- `CotacaoLinha`: o retorno da cotação de uma linha (status, opções, mais barata).
+A conversão para dict só acontece na borda: JSON (`para_dict`) e planilha (`linhas_resultado`).
+"""
+import sys
+
+def _texto(valor):
+    return sys.intern(valor) if type(valor) is str else valor
+
+class OpcaoFrete:
+    __slots__ = ("transportadora", "integrador", "total", "prazo", "servico", "imagem", "observacao")
+
+    def __init__(self, transportadora="N/D", integrador="", total=0.0, prazo="N/A",
+                 servico="Padrão", imagem="", observacao=""):
+        self.transportadora = _texto(transportadora)
+        self.integrador = _texto(integrador)
+        self.total = total
+        self.prazo = _texto(prazo)
+        self.servico = _texto(servico)
+        self.imagem = _texto(imagem)
+        self.observacao = _texto(observacao)
+
+    def para_dict(self):
+        return {campo: getattr(self, campo) for campo in self.__slots__}
+
+    def __repr__(self):
+        return f"OpcaoFrete({self.transportadora!r}, total={self.total!r}, prazo={self.prazo!r})"
+
+class CotacaoLinha:
+    """Resultado da cotação de uma linha: status 'sucesso' | 'sem_resultado' | 'erro'."""
+    __slots__ = ("status", "mensagem", "opcoes", "mais_barata")
+
+    def __init__(self, status, mensagem=None, opcoes=(), mais_barata=None):
+        self.status = status
+        self.mensagem = mensagem
+        self.opcoes = tuple(opcoes)
+        self.mais_barata = mais_barata
+
+    @property
+    def sucesso(self):
+        return self.status == "sucesso"
+
+    def para_dict(self):
+        dados = {"status": self.status}
+        if self.mensagem is not None:
+            dados["mensagem"] = self.mensagem
+        if self.sucesso:
+            dados["mais_barata"] = self.mais_barata.para_dict() if self.mais_barata else None
+            dados["todas_opcoes"] = [o.para_dict() for o in self.opcoes]
+        return dados
+
+    def __repr__(self):
+        return f"CotacaoLinha({self.status!r}, opcoes={len(self.opcoes)}, mensagem={self.mensagem!r})"
+
+# ------------------------------------------------------------
+# Borda da planilha
+# ------------------------------------------------------------
+COLUNAS_MAIS_BARATA = (
+    ("transportadora_mais_barata", "transportadora"),
+    ("integrador_mais_barato", "integrador"),
+    ("valor_frete_mais_barato", "total"),
+    ("prazo_mais_barato", "prazo"),
+    ("servico_mais_barato", "servico"),
+    ("imagem_mais_barata", "imagem"),
+    ("observacao_mais_barata", "observacao"),
+)
+COLUNAS_OPCAO = (
+    ("transportadora", "transportadora"),
+    ("integrador", "integrador"),
+    ("valor_frete", "total"),
+    ("prazo", "prazo"),
+    ("servico", "servico"),
+    ("imagem", "imagem"),
+    ("observacao", "observacao"),
+)
+
+def linhas_resultado(row, cotacao, tipo_retorno):
+    """
+    Linhas (dicts) da planilha de resultado para uma linha de entrada, geradas sob demanda.
+    Mesmo formato de antes: dados da linha + status/mensagem, colunas da mais barata,
+    ou uma linha por opção com `melhor_opcao`.
+    """
+    if cotacao is None or not cotacao.sucesso:
+        yield {
+            **row,
+            "status": cotacao.status if cotacao else "erro",
+            "mensagem": (cotacao.mensagem if cotacao else None) or "Erro na cotação"
+        }
+        return
+
+    mb = cotacao.mais_barata or OpcaoFrete()
+    if tipo_retorno == "mais_barata":
+        yield {**row, **{coluna: getattr(mb, campo) for coluna, campo in COLUNAS_MAIS_BARATA}}
+        return
+
+    for opcao in cotacao.opcoes:
+        yield {
+            **row,
+            **{coluna: getattr(opcao, campo) for coluna, campo in COLUNAS_OPCAO},
+            "melhor_opcao": "Sim" if opcao.total == mb.total else "Não"
+        }
@@ -0,0 +1,184 @@
+"""
+Tabela de cotações pré-calculadas para as rotas mais frequentes do /cotar.
+
+Cada consulta do /cotar é contabilizada por "rota" (payload normalizado: CEPs,
+CNPJs, perfil dos pacotes e contratos). As rotas mais consultadas são mantidas
+quentes por uma thread de atualização que respeita um orçamento de chamadas por
+minuto; enquanto a cotação guardada estiver dentro do limite de frescor, o
+/cotar responde direto da tabela, informando `cotado_em`. Rota cuja atualização
+falha fica de fora por um tempo que dobra a cada falha seguida (até o frescor),
+para não consumir o orçamento das demais.
+
+O estado é por processo (como o restante do armazenamento em memória), e o
+orçamento também: com vários workers web, o app.py divide ROTAS_ORCAMENTO_POR_MINUTO
+por WEB_CONCURRENCY.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+def chave_rota(payload: dict, contratos) -> str:
+    """Identifica a rota: payload sem textos livres + contratos consultados."""
+    base = {k: v for k, v in payload.items() if k != "produtos"}
+    base["produtos"] = [{k: v for k, v in p.items() if k != "descricao"} for p in payload.get("produtos", [])]
+    base["contratos"] = list(contratos)
+    return hashlib.sha1(json.dumps(base, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+class EntradaRota:
+    def __init__(self, payload, contratos):
+        self.payload = payload
+        self.contratos = list(contratos)
+        self.consultas = 0.0
+        self.resposta = None
+        self.cotado_em = None   # epoch (time.time()) da última cotação guardada
+        self.falhas = 0         # atualizações seguidas sem sucesso
+        self.tentar_apos = 0.0  # epoch; antes disso a rota não é atualizada (backoff)
+
+    def idade(self):
+        return None if self.cotado_em is None else time.time() - self.cotado_em
+
+class TabelaRotas:
+    def __init__(self, frescor=900, max_rotas=50, orcamento_por_minuto=6, min_consultas=3, max_historico=5000):
+        self.frescor = frescor
+        self.max_rotas = max_rotas
+        self.orcamento_por_minuto = orcamento_por_minuto
+        self.min_consultas = min_consultas
+        self.max_historico = max_historico
+        self.rotas = {}
+        self.acertos = 0
+        self.atualizacoes = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._cotador = None
+
+    # ---------------- consulta / armazenamento ----------------
+    def consultar(self, chave, payload, contratos):
+        """
+        Contabiliza a consulta da rota e devolve (resposta, cotado_em) se houver
+        cotação dentro do frescor; senão None.
+        """
+        with self._lock:
+            entrada = self.rotas.get(chave)
+            if entrada is None:
+                if len(self.rotas) >= self.max_historico:
+                    self._podar()
+                entrada = self.rotas[chave] = EntradaRota(payload, contratos)
+            entrada.consultas += 1
+            idade = entrada.idade()
+            if entrada.resposta is not None and idade is not None and idade <= self.frescor:
+                self.acertos += 1
+                return entrada.resposta, entrada.cotado_em
+        return None
+
+    def armazenar(self, chave, resposta, cotado_em=None):
+        with self._lock:
+            entrada = self.rotas.get(chave)
+            if entrada is not None:
+                entrada.resposta = resposta
+                entrada.cotado_em = cotado_em or time.time()
+                entrada.falhas = 0
+                entrada.tentar_apos = 0.0
+
+    def _falhou(self, chave):
+        """Atualização sem sucesso: a rota espera 30 s, 60 s, 120 s... (até o frescor)."""
+        with self._lock:
+            entrada = self.rotas.get(chave)
+            if entrada is not None:
+                entrada.falhas += 1
+                espera = min(self.frescor, 30 * 2 ** min(entrada.falhas - 1, 10))
+                entrada.tentar_apos = time.time() + espera
+
+    def _podar(self):
+        """Descarta a metade menos consultada do histórico (chamado com o lock)."""
+        ordenadas = sorted(self.rotas.items(), key=lambda kv: kv[1].consultas)
+        for chave, _ in ordenadas[:len(ordenadas) // 2]:
+            del self.rotas[chave]
+
+    # ---------------- atualização em segundo plano ----------------
+    def _proxima(self):
+        """
+        Rota frequente com a cotação mais antiga (ou inexistente) que já passou da metade
+        do frescor, fora as que estão esperando depois de uma falha.
+        """
+        agora = time.time()
+        with self._lock:
+            frequentes = sorted(
+                (kv for kv in self.rotas.items() if kv[1].consultas >= self.min_consultas),
+                key=lambda kv: kv[1].consultas, reverse=True
+            )[:self.max_rotas]
+            vencendo = [kv for kv in frequentes
+                        if kv[1].tentar_apos <= agora and (kv[1].idade() is None or kv[1].idade() > self.frescor / 2)]
+            if not vencendo:
+                return None
+            return min(vencendo, key=lambda kv: kv[1].cotado_em or 0)
+
+    def _decair(self):
+        """Reduz as contagens para que rotas que pararam de ser usadas saiam do topo."""
+        with self._lock:
+            for entrada in self.rotas.values():
+                entrada.consultas *= 0.5
+
+    def _loop(self):
+        saldo = float(self.orcamento_por_minuto)
+        ultimo = ultimo_decaimento = time.monotonic()
+        while True:
+            time.sleep(1.0)
+            agora = time.monotonic()
+            saldo = min(float(self.orcamento_por_minuto), saldo + (agora - ultimo) * self.orcamento_por_minuto / 60.0)
+            ultimo = agora
+            if agora - ultimo_decaimento >= self.frescor:
+                self._decair()
+                ultimo_decaimento = agora
+
+            proxima = self._proxima()
+            if proxima is None:
+                continue
+            chave, entrada = proxima
+            custo = len(entrada.contratos)
+            # Rota mais cara que o balde cheio sai com o balde cheio (o saldo fica negativo)
+            if saldo < min(custo, self.orcamento_por_minuto):
+                continue
+            saldo -= custo
+            try:
+                resposta = self._cotador(entrada.payload, entrada.contratos)
+            except Exception:
+                log.exception("Falha ao atualizar rota da tabela")
+                resposta = None
+            if resposta is None:
+                self._falhou(chave)
+            else:
+                self.armazenar(chave, resposta)
+                self.atualizacoes += 1
+                log.info(f"Rota atualizada em segundo plano ({entrada.payload.get('cep_origem')} -> "
+                         f"{entrada.payload.get('cep_destino')}, contratos={entrada.contratos})")
+
+    def iniciar(self, cotador):
+        """
+        Sobe a thread de atualização (uma vez por processo).
+        `cotador(payload, contratos)` devolve a resposta de sucesso a guardar, ou None.
+        """
+        with self._lock:
+            if self._thread is not None or self.orcamento_por_minuto <= 0:
+                return
+            self._cotador = cotador
+            self._thread = threading.Thread(target=self._loop, name="tabela-rotas", daemon=True)
+            self._thread.start()
+
+    def snapshot(self):
+        with self._lock:
+            quentes = [e for e in self.rotas.values() if e.resposta is not None and (e.idade() or 0) <= self.frescor]
+            return {
+                "rotas_conhecidas": len(self.rotas),
+                "rotas_quentes": len(quentes),
+                "acertos": self.acertos,
+                "atualizacoes": self.atualizacoes,
+                "frescor_segundos": self.frescor,
+            }
+
+def formatar_cotado_em(epoch: float) -> str:
+    return datetime.fromtimestamp(epoch).isoformat(timespec="seconds")
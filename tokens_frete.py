@@ -0,0 +1,246 @@
+"""
+Pool de credenciais (TOKEN_API) da API de fretes, cada uma com o próprio orçamento.
+
+Configuração (app.py):
+- TOKENS_API="tokA|10,tokB|5" → dois tokens, 10 e 5 chamadas/s; sem "|rps" vale
+  FRETE_TOKEN_RPS (0 = sem limite de taxa);
+- sem TOKENS_API, só o TOKEN_API: o pool só entra em ação se FRETE_TOKEN_RPS > 0;
+  caso contrário `cliente_frete` envia o header do chamador, como sempre.
+
+Cada token é um balde (token bucket) de `rps` chamadas/s. Sem FRETE_TOKEN_RAJADA_S
+as chamadas saem espaçadas (1/rps), o que respeita também limites de janela deslizante
+do upstream; com ele, acumula até `rps * FRETE_TOKEN_RAJADA_S` chamadas para rajadas
+(numa janela de 1 s podem sair até o dobro do rps). `cliente_frete.post` pega o token
+com mais folga (saldo proporcional à capacidade, depois o com menos chamadas em voo);
+chamadas interativas esperando passam na frente da massa. 429 esfria o token por Retry-After
+(ou FRETE_TOKEN_ESFRIAR_429 s, dobrando a cada 429 seguido); 401 esfria por
+FRETE_TOKEN_ESFRIAR_401 s. Token esfriando só volta a ser usado depois do prazo.
+
+O orçamento é global, mas cada processo tem o próprio pool: o despachante
+(despacho.py) ajusta `fracao` a cada sincronia — os workers web dividem o orçamento
+entre si e a massa fica com o que sobra da reserva interativa (ou do uso real dos
+workers web, se maior), dividido entre os processos da massa.
+"""
+import logging
+import os
+import threading
+import time
+
+import requests
+
+log = logging.getLogger(__name__)
+
+RPS_PADRAO = float(os.environ.get("FRETE_TOKEN_RPS", 0))
+RAJADA_S = float(os.environ.get("FRETE_TOKEN_RAJADA_S", 0))
+ESFRIAR_429 = float(os.environ.get("FRETE_TOKEN_ESFRIAR_429", 30))
+ESFRIAR_401 = float(os.environ.get("FRETE_TOKEN_ESFRIAR_401", 300))
+ESFRIAR_MAX = 600.0
+
+INTERATIVO = "interativo"  # mesmo valor de despacho.INTERATIVO
+
+class SemTokenDisponivel(requests.exceptions.RequestException):
+    """Todos os tokens esfriando além do timeout da chamada."""
+
+def ler_config(tokens_api, token_api, rps_padrao=RPS_PADRAO):
+    """
+    Lista de (token, rps) a partir de TOKENS_API ("tok|rps,tok2") ou, na falta dele,
+    do TOKEN_API com o rps padrão. Lista vazia: pool desligado.
+    """
+    tokens = []
+    for parte in (tokens_api or "").split(","):
+        parte = parte.strip()
+        if not parte:
+            continue
+        valor, _, rps = parte.rpartition("|") if "|" in parte else (parte, "", "")
+        tokens.append((valor.strip(), float(rps) if rps.strip() else rps_padrao))
+    if not tokens and token_api and rps_padrao > 0:
+        tokens.append((token_api, rps_padrao))
+    return tokens
+
+class _Token:
+    __slots__ = ("valor", "nome", "rps", "saldo", "atualizado", "em_voo", "esfriar_ate",
+                 "falhas", "chamadas", "recusas")
+
+    def __init__(self, valor, rps):
+        self.valor = valor
+        self.nome = f"…{valor[-4:]}" if len(valor) > 8 else "…"  # nunca o token inteiro em status/log
+        self.rps = max(0.0, float(rps))
+        self.saldo = None          # preenchido no primeiro reabastecimento (balde cheio)
+        self.atualizado = time.monotonic()
+        self.em_voo = 0
+        self.esfriar_ate = 0.0
+        self.falhas = 0            # 429 seguidos (backoff exponencial)
+        self.chamadas = 0
+        self.recusas = 0           # respostas 401/429
+
+class PoolTokens:
+    def __init__(self):
+        self._tokens = []
+        self._cond = threading.Condition()
+        self._interativos_esperando = 0
+        self.fracao = 1.0          # parcela do orçamento deste processo (ajustada pelo despachante)
+        self._janela_inicio = time.monotonic()
+        self._janela_chamadas = 0
+        self.taxa = 0.0            # chamadas/s deste processo (janela de ~2 s)
+
+    def configurar(self, tokens):
+        """`tokens`: lista de (valor, rps) — ver `ler_config`."""
+        with self._cond:
+            self._tokens = [_Token(valor, rps) for valor, rps in tokens]
+            self._cond.notify_all()
+        if self._tokens:
+            log.info(f"Pool de tokens da API: {len(self._tokens)} token(s), "
+                     f"{' + '.join(f'{t.rps:g}/s' if t.rps else 'sem limite' for t in self._tokens)}")
+
+    @property
+    def ativo(self):
+        return bool(self._tokens)
+
+    def orcamento_total(self):
+        """Chamadas/s somando todos os tokens (None se algum não tem limite)."""
+        if any(t.rps <= 0 for t in self._tokens):
+            return None
+        return sum(t.rps for t in self._tokens)
+
+    def __len__(self):
+        return len(self._tokens)
+
+    # --------------------------------------------------------
+    # Saldo
+    # --------------------------------------------------------
+    def _capacidade(self, t):
+        return max(1.0, t.rps * self.fracao * RAJADA_S)
+
+    def _reabastecer(self, t, agora):
+        if t.rps <= 0:
+            return
+        capacidade = self._capacidade(t)
+        if t.saldo is None:
+            t.saldo = capacidade
+        else:
+            t.saldo = min(capacidade, t.saldo + (agora - t.atualizado) * t.rps * self.fracao)
+        t.atualizado = agora
+
+    def _folga(self, t):
+        """Ordem de preferência: mais saldo relativo, depois menos chamadas em voo."""
+        saldo = 1.0 if t.rps <= 0 else t.saldo / self._capacidade(t)
+        return saldo, -t.em_voo
+
+    def _escolher(self, agora):
+        """Token utilizável agora (ou None) e quanto esperar até o próximo ficar livre."""
+        melhor, espera = None, None
+        for t in self._tokens:
+            if t.esfriar_ate > agora:
+                livre_em = t.esfriar_ate - agora
+            else:
+                self._reabastecer(t, agora)
+                if t.rps <= 0 or t.saldo >= 1.0:
+                    if melhor is None or self._folga(t) > self._folga(melhor):
+                        melhor = t
+                    continue
+                livre_em = (1.0 - t.saldo) / (t.rps * self.fracao)
+            espera = livre_em if espera is None else min(espera, livre_em)
+        return melhor, espera
+
+    # --------------------------------------------------------
+    # Uso
+    # --------------------------------------------------------
+    def adquirir(self, classe=INTERATIVO, timeout=30):
+        """Reserva uma chamada no token com mais folga; espera se todos estiverem sem saldo."""
+        limite = time.monotonic() + timeout
+        interativo = classe == INTERATIVO
+        with self._cond:
+            if interativo:
+                self._interativos_esperando += 1
+            try:
+                while True:
+                    agora = time.monotonic()
+                    token, espera = self._escolher(agora)
+                    # Prioridade estrita: a massa não pega token com cotação interativa esperando
+                    if token is not None and (interativo or not self._interativos_esperando):
+                        if token.rps > 0:
+                            token.saldo -= 1.0
+                        token.em_voo += 1
+                        token.chamadas += 1
+                        self._janela_chamadas += 1
+                        return token
+                    if espera is not None and agora + espera > limite:
+                        raise SemTokenDisponivel(
+                            f"Nenhum token da API disponível nos próximos {timeout:g}s "
+                            f"({len(self._tokens)} token(s) esfriando ou sem saldo)")
+                    self._cond.wait(min(espera or 0.05, 0.5))
+            finally:
+                if interativo:
+                    self._interativos_esperando -= 1
+                    self._cond.notify_all()
+
+    def devolver(self, token, status=None, retry_after=None):
+        """Fim da chamada: 429 e 401 esfriam o token."""
+        with self._cond:
+            token.em_voo = max(0, token.em_voo - 1)
+            if status == 429:
+                token.falhas += 1
+                token.recusas += 1
+                tempo = _segundos(retry_after) or ESFRIAR_429 * 2 ** min(token.falhas - 1, 4)
+                self._esfriar(token, tempo, "429")
+            elif status == 401:
+                token.recusas += 1
+                self._esfriar(token, ESFRIAR_401, "401")
+            elif status is not None:
+                token.falhas = 0
+            self._cond.notify_all()
+
+    def _esfriar(self, token, segundos, motivo):
+        segundos = min(segundos, ESFRIAR_MAX)
+        token.esfriar_ate = max(token.esfriar_ate, time.monotonic() + segundos)
+        token.saldo = 0.0
+        log.warning(f"Token {token.nome} da API recusado ({motivo}); esfriando por {segundos:.0f}s")
+
+    def disponiveis(self):
+        """Quantos tokens não estão esfriando."""
+        agora = time.monotonic()
+        with self._cond:
+            return sum(1 for t in self._tokens if t.esfriar_ate <= agora)
+
+    # --------------------------------------------------------
+    # Divisão entre processos e situação
+    # --------------------------------------------------------
+    def definir_fracao(self, fracao):
+        with self._cond:
+            agora = time.monotonic()
+            for t in self._tokens:
+                self._reabastecer(t, agora)  # o tempo até aqui conta na fração antiga
+            self.fracao = min(1.0, max(0.01, fracao))
+            for t in self._tokens:
+                if t.saldo is not None:
+                    t.saldo = min(t.saldo, self._capacidade(t))
+            self._cond.notify_all()
+
+    def snapshot(self):
+        agora = time.monotonic()
+        with self._cond:
+            decorrido = agora - self._janela_inicio
+            if decorrido >= 2.0:
+                self.taxa = self._janela_chamadas / decorrido
+                self._janela_inicio, self._janela_chamadas = agora, 0
+            return {
+                "fracao": round(self.fracao, 3),
+                "taxa": round(self.taxa, 2),
+                "tokens": [{
+                    "token": t.nome,
+                    "rps": round(t.rps * self.fracao, 2) if t.rps else None,
+                    "em_voo": t.em_voo,
+                    "chamadas": t.chamadas,
+                    "recusas": t.recusas,
+                    "esfriando_s": round(max(0.0, t.esfriar_ate - agora), 1),
+                } for t in self._tokens],
+            }
+
+def _segundos(retry_after):
+    """Retry-After em segundos (a forma com data HTTP é ignorada)."""
+    try:
+        return max(0.0, float(retry_after)) if retry_after else None
+    except (TypeError, ValueError):
+        return None
+
+pool = PoolTokens()
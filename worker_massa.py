@@ -0,0 +1,277 @@
+"""
+Processos de cotação em massa.
+
+Rodam fora do gunicorn: cada processo reivindica um job pendente em fila_jobs, cota as
+linhas com o controle AIMD e grava o XLSX em MASSA_RESULTADOS_DIR. Progresso, métricas
+e estatísticas vão para o SQLite a cada MASSA_SINCRONIA_SEGUNDOS, e os pedidos feitos
+por qualquer worker web (cancelamento, XLSX parcial) são lidos de volta no mesmo ciclo.
+
+Uso:
+    python worker_massa.py            # MASSA_WORKERS processos (padrão 2), cada um com
+                                      # até MASSA_JOBS_POR_PROCESSO jobs simultâneos (padrão 2)
+
+O gunicorn.conf.py sobe este script junto com o servidor (a não ser que
+MASSA_WORKERS_EXTERNOS=1, quando ele é iniciado à parte, na mesma máquina: a fila
+é um arquivo SQLite local, MASSA_DB).
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import despacho
+import fila_jobs
+import perfil
+
+log = logging.getLogger("worker_massa")
+
+INTERVALO_SINCRONIA = float(os.environ.get("MASSA_SINCRONIA_SEGUNDOS", 0.5))
+INTERVALO_OCIOSO = 1.0          # s entre consultas à fila quando não há job
+INTERVALO_ORFAOS = 10.0         # s entre buscas por jobs órfãos (ver fila_jobs.recuperar_orfaos)
+RETENCAO_HORAS = float(os.environ.get("MASSA_RETENCAO_HORAS", 24))
+
+def subir_processo():
+    """
+    Inicia `python worker_massa.py` como processo filho (usado pelo app.run). Herda o
+    diretório atual do processo web: MASSA_DB, MASSA_RESULTADOS_DIR e UPLOAD_FOLDER são
+    relativos a ele, e web e worker precisam enxergar os mesmos arquivos.
+    """
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__)])
+
+# ------------------------------------------------------------
+# Execução de um job
+# ------------------------------------------------------------
+def _espera_limite(etapas):
+    """Espera por vaga no despachante e por saldo de token, somada entre as chamadas."""
+    total_ms = sum(etapas[nome]["total_ms"] for nome in ("despacho", "token") if nome in etapas)
+    chamadas = etapas.get("despacho", {}).get("n", 0)
+    return {
+        "espera_limite_s": round(total_ms / 1000, 1),
+        "espera_limite_media_ms": round(total_ms / chamadas, 1) if chamadas else None,
+    }
+
+def _publicar(estado, origem, final=False, **extra):
+    etapas = estado.etapas.snapshot()
+    campos = {
+        "atual": estado.atual,
+        "metricas": {**estado.controle.snapshot(),
+                     **estado.ritmo.snapshot(max(0, estado.total - estado.atual), final),
+                     **_espera_limite(etapas),
+                     "etapas": etapas, "despacho": despacho.despachante.snapshot()},
+        "estatisticas": estado.estatisticas.snapshot(),
+        **extra
+    }
+    if origem == "xlsx":
+        campos["total"] = estado.total  # no streaming o total é mantido pela web
+    cancelar, recebendo, total, parcial_pedido = fila_jobs.publicar_progresso(estado.job_id, **campos)
+    if not final:
+        estado.cancelar = estado.cancelar or cancelar
+        estado.recebendo = recebendo
+        estado.total = total
+        estado.parcial_pedido = parcial_pedido
+
+def _sincronizar(estado, origem, parar, gravar_parcial):
+    """
+    Thread do job: publica o progresso e lê cancelamento e pedidos de XLSX parcial até
+    `parar` ser setado. O parcial é gravado em outra thread para não atrasar o heartbeat.
+    """
+    atendido = 0.0
+    gravando = None
+    while not parar.wait(INTERVALO_SINCRONIA):
+        try:
+            _publicar(estado, origem)
+        except Exception:
+            log.exception(f"Falha ao publicar progresso do job {estado.job_id}")
+            continue
+        pedido = estado.parcial_pedido
+        if pedido and pedido > atendido and (gravando is None or not gravando.is_alive()):
+            atendido = pedido
+            gravando = threading.Thread(target=gravar_parcial, args=(pedido,), daemon=True)
+            gravando.start()
+
+def _linhas_do_banco(estado):
+    """Linhas do upload em streaming, à medida que a web as grava; apaga as já consumidas."""
+    ultimo = 0
+    while not estado.cancelar:
+        recebendo = estado.recebendo
+        with estado.etapas.medir("fila_leitura"):
+            linhas = fila_jobs.ler_linhas(estado.job_id, ultimo)
+        for seq, linha in linhas:
+            ultimo = seq
+            yield linha
+        if linhas:
+            fila_jobs.apagar_linhas(estado.job_id, ultimo)
+        elif not recebendo:
+            # `recebendo` foi lido antes da consulta: nada mais vai chegar
+            return
+        else:
+            time.sleep(0.2)
+
+def executar_job(job, app):
+    from massa_blueprint import (ProgressState, _novo_controle, _executar_linhas, _gravar_resultado,
+                                 _resultados_ate_agora, ler_planilha)
+
+    logger = app.logger
+    estado = ProgressState(job["id"], job["tipo_retorno"], _novo_controle(app.config))
+    estado.dono = job["dono"] or job["id"]  # jobs do mesmo usuário dividem a mesma vez no rodízio
+    estado.recebendo = bool(job["recebendo"])
+    estado.total = job["total"]
+    if job["perfil"] or app.config.get("PERFIL_ATIVO"):
+        estado.perfilador = perfil.Perfilador()
+    origem = job["origem"]
+    caminho = os.path.join(fila_jobs.PASTA_RESULTADOS, f"{job['id']}.xlsx")
+    gravacao = threading.Lock()  # parcial e final usam o mesmo arquivo
+    encerrado = threading.Event()
+
+    def _gravar_parcial(pedido):
+        with gravacao:
+            if encerrado.is_set():
+                return  # o XLSX final já foi (ou está sendo) gravado
+            try:
+                resultados = _resultados_ate_agora(estado, logger, "Ainda não cotada", parcial=True)
+                etag = _gravar_resultado(resultados, caminho, estado, logger, etapa="xlsx_parcial")
+            except Exception:
+                logger.exception(f"Falha ao gravar o XLSX parcial do job {job['id']}")
+                return
+            if etag:
+                fila_jobs.publicar_progresso(job["id"], arquivo_resultado=caminho, etag=etag, parcial_em=pedido)
+
+    parar = threading.Event()
+    sincronia = threading.Thread(target=_sincronizar, args=(estado, origem, parar, _gravar_parcial), daemon=True)
+    sincronia.start()
+
+    final = {}
+    try:
+        with app.app_context(), perfil.ativo(estado.perfilador):
+            url_api = app.config.get("URL_API")
+            token = app.config.get("TOKEN_API")
+            if not url_api or not token:
+                raise RuntimeError("URL_API ou TOKEN_API não configurados")
+
+            if origem == "xlsx":
+                linhas = ler_planilha(job["arquivo_entrada"], estado, logger)
+                if linhas is not None:
+                    estado.total = len(linhas)
+                    estado.restantes = lambda n: linhas[n:]
+            else:
+                linhas = _linhas_do_banco(estado)
+                # seq começa em 1 e é contígua: as n primeiras linhas são as de seq <= n
+                estado.restantes = lambda n: [linha for _, linha in fila_jobs.ler_linhas(job["id"], n, limite=-1)]
+
+            if linhas is not None:
+                resultados = _executar_linhas(linhas, url_api, token, estado, logger)
+                # Cancelado também grava: o que já foi cotado (e pago) não se perde
+                if not estado.erro:
+                    with gravacao:
+                        encerrado.set()
+                        etag = _gravar_resultado(resultados, caminho, estado, logger)
+                    if etag:
+                        final.update(arquivo_resultado=caminho, etag=etag)
+    except Exception:
+        estado.erro = "Erro geral no processamento"
+        logger.exception("Erro geral no processamento")
+    finally:
+        encerrado.set()
+        parar.set()
+        sincronia.join()
+
+    erro = estado.erro or fila_jobs.obter_job(job["id"])["erro"]
+    if erro:
+        final.update(status="erro", erro=erro)
+    elif estado.cancelar:
+        final["status"] = "cancelado"
+    else:
+        final["status"] = "concluido"
+    _publicar(estado, origem, final=True, recebendo=0, **final)
+
+    # Entrada não é mais necessária
+    if origem == "xlsx":
+        try:
+            os.remove(job["arquivo_entrada"])
+        except Exception:
+            pass
+    else:
+        fila_jobs.apagar_linhas(job["id"])
+    logger.info(f"Job {job['id']} encerrado: {final['status']} ({estado.atual}/{estado.total} linhas) "
+                f"[{estado.etapas.resumo()}]")
+    if estado.perfilador is not None:
+        caminho = estado.perfilador.salvar(app.config.get("PERFIL_DIR", "perfis"), f"massa_{job['id']}")
+        logger.info(f"Perfil do job {job['id']} salvo em {caminho}")
+
+# ------------------------------------------------------------
+# Processos
+# ------------------------------------------------------------
+def _laco():
+    """
+    Corpo de cada processo: mantém até MASSA_JOBS_POR_PROCESSO jobs rodando ao mesmo
+    tempo (em threads), que revezam as vagas da massa no despachante.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from app import app
+
+    despacho.despachante.configurar_massa(int(os.environ.get("MASSA_WORKERS", 2)))
+    simultaneos = max(1, int(os.environ.get("MASSA_JOBS_POR_PROCESSO", 2)))
+    ativos = []
+    ultima_limpeza = ultima_busca_orfaos = 0.0
+    while True:
+        if time.monotonic() - ultima_busca_orfaos > INTERVALO_ORFAOS:
+            ultima_busca_orfaos = time.monotonic()
+            try:
+                fila_jobs.recuperar_orfaos()
+            except Exception:
+                log.exception("Falha ao recuperar jobs órfãos")
+        if RETENCAO_HORAS > 0 and time.monotonic() - ultima_limpeza > 3600:
+            ultima_limpeza = time.monotonic()
+            try:
+                fila_jobs.limpar_antigos(RETENCAO_HORAS)
+            except Exception:
+                log.exception("Falha ao limpar jobs antigos")
+        ativos = [t for t in ativos if t.is_alive()]
+        job = None
+        if len(ativos) < simultaneos:
+            try:
+                job = fila_jobs.reivindicar_proximo(os.getpid())
+            except Exception:
+                log.exception("Falha ao consultar a fila de jobs")
+        if job is None:
+            time.sleep(INTERVALO_OCIOSO)
+            continue
+        t = threading.Thread(target=executar_job, args=(job, app), name=f"job-{job['id'][:8]}", daemon=True)
+        t.start()
+        ativos.append(t)
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:%(message)s")
+    quantidade = max(1, int(os.environ.get("MASSA_WORKERS", 2)))
+    contexto = multiprocessing.get_context("spawn")  # processos limpos, sem herdar threads/locks
+    processos = []
+    encerrando = threading.Event()
+
+    def _encerrar(*_):
+        encerrando.set()
+
+    signal.signal(signal.SIGTERM, _encerrar)
+    signal.signal(signal.SIGINT, _encerrar)
+
+    log.info(f"Iniciando {quantidade} processo(s) de cotação em massa (fila: {fila_jobs.CAMINHO_DB})")
+    while not encerrando.is_set():
+        # Repõe processos que morreram (o job órfão vira erro pelo heartbeat)
+        processos = [p for p in processos if p.is_alive()]
+        while len(processos) < quantidade:
+            p = contexto.Process(target=_laco, name="massa", daemon=True)
+            p.start()
+            processos.append(p)
+        encerrando.wait(1.0)
+
+    for p in processos:
+        p.terminate()
+    for p in processos:
+        p.join(timeout=10)
+
+if __name__ == "__main__":
+    main()